@@ -0,0 +1,97 @@
+# CPU time per broadcast against the number of connected clients, comparing
+# the old per-client send_json with encoding once and sharing the bytes.
+# Run from the repository root: python -m benchmarks.bench_broadcast
+
+import asyncio
+import json
+import time
+
+import protocol
+import server
+
+CLIENT_COUNTS = [1, 10, 50, 200]
+BROADCASTS = 200
+
+
+class FakeWebSocket:
+    # Stands in for a starlette WebSocket, sending is free
+
+    async def send_json(self, data, mode="text"):
+        # What starlette does for every recipient
+        text = json.dumps(data)
+        if mode == "binary":
+            text.encode("utf-8")
+
+    async def send_bytes(self, data):
+        pass
+
+    async def send_text(self, data):
+        pass
+
+    async def close(self, code=1000):
+        pass
+
+
+def make_messages():
+    position = {"event": "game", "type": "playerposition", "client_id": "ABC123", "data": {"x": 3201.5, "y": 310.25}}
+    placed_items = {"event": "game", "type": "responsemapplaceditems", "client_id": "ABC123", "data": [
+        {"x": index * 32, "y": 64, "type": "CHEST", "chest_id": "C" + str(index), "chest_inventory": {"3": 12, "5": 4}}
+        for index in range(500)
+    ]}
+    return {"playerposition": position, "responsemapplaceditems (500 chests)": placed_items}
+
+
+async def old_broadcast(websockets, message):
+    for websocket in websockets:
+        await websocket.send_json(message, "binary")
+
+
+async def wait_for_queues(manager):
+    while any(len(send_queue.messages) > 0 for send_queue in manager.send_queues.values()):
+        await asyncio.sleep(0)
+
+
+async def run(client_count, message):
+    manager = server.ConnectionManager()
+    websockets = []
+    for index in range(client_count):
+        websocket = FakeWebSocket()
+        websockets.append(websocket)
+        manager.connect("C" + str(index), "C" + str(index), "player" + str(index), websocket)
+
+    start = time.process_time()
+    for _ in range(BROADCASTS):
+        await old_broadcast(websockets, message)
+    old_time = (time.process_time() - start) / BROADCASTS
+
+    start = time.process_time()
+    for _ in range(BROADCASTS):
+        await manager.broadcast(message=message)
+        await wait_for_queues(manager)
+    new_time = (time.process_time() - start) / BROADCASTS
+
+    for send_queue in manager.send_queues.values():
+        send_queue.close()
+    return old_time, new_time
+
+
+def main():
+    # Keep every message, this measures encoding and not coalescing
+    server.SERVER_SETTINGS["send_queue_coalesce_movement"] = False
+    server.SERVER_SETTINGS["send_queue_size"] = 1_000_000
+
+    encoders = {"json": None}
+    if protocol.orjson is not None:
+        encoders["orjson"] = protocol.orjson
+
+    for encoder, module in encoders.items():
+        protocol.orjson = module
+        for name, message in make_messages().items():
+            print(f"{name}, encoder: {encoder}")
+            for client_count in CLIENT_COUNTS:
+                old_time, new_time = asyncio.run(run(client_count, message))
+                print(f"  {client_count:>4} clients | send_json per client {old_time * 1e3:>8.3f} ms | encode once {new_time * 1e3:>8.3f} ms | {old_time / new_time:>5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
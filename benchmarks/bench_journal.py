@@ -0,0 +1,72 @@
+# Mutation throughput with the write-ahead journal on and off.
+# Run from the repository root: python -m benchmarks.bench_journal
+
+import asyncio
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from journal import Journal
+from tilestore import TileStore
+
+MUTATIONS = 200_000
+BATCH = 1_000
+
+
+def make_mutations(count):
+    rng = random.Random(1)
+    mutations = []
+    for index in range(count):
+        if index % 10 == 0:
+            mutations.append(({"op": "playerposition", "os_uid": "player" + str(index % 30), "position": {"x": rng.random() * 6400, "y": rng.random() * 9600}}, ("playerposition", index % 30)))
+        else:
+            mutations.append(({"op": "settile", "x": rng.randrange(200), "y": rng.randrange(300), "id": rng.choice((-1, 2, 5))}, None))
+    return mutations
+
+
+async def run(mutations, journal):
+    tiles = TileStore(200, 300)
+    writer = asyncio.get_running_loop().create_task(journal.run()) if journal is not None else None
+
+    start = time.perf_counter()
+    for index, (entry, coalesce_key) in enumerate(mutations):
+        if entry["op"] == "settile":
+            tiles.set(entry["x"], entry["y"], entry["id"])
+
+        if journal is not None:
+            journal.append(dict(entry), coalesce_key)
+
+        # Yield like the websocket handler does between messages
+        if index % BATCH == 0:
+            await asyncio.sleep(0)
+    handled = time.perf_counter() - start
+
+    if journal is not None:
+        await journal.flush()
+        writer.cancel()
+    durable = time.perf_counter() - start
+
+    return handled, durable
+
+
+def main():
+    mutations = make_mutations(MUTATIONS)
+
+    handled, _ = asyncio.run(run(mutations, None))
+    print(f"journal off | {MUTATIONS / handled:>10.0f} mutations/s")
+
+    for flush_interval in (0.05, 0.2, 1.0):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(Path(directory) / "journal.log", flush_interval=flush_interval)
+            handled, durable = asyncio.run(run(mutations, journal))
+            size = journal.path.stat().st_size
+            journal.close()
+
+        print(f"journal on (flush every {flush_interval}s) | {MUTATIONS / handled:>10.0f} mutations/s handled"
+              f" | {MUTATIONS / durable:>10.0f} mutations/s on disk | {journal.stats['flushes']} fsyncs"
+              f" | {journal.stats['coalesced']} coalesced | {size / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Message size, bytes per second and encode/parse cost of the hot messages
+# in the JSON and binary protocols.
+# Run from the repository root: python -m benchmarks.bench_protocol
+
+import json
+import time
+
+import protocol
+
+ITERATIONS = 100_000
+PLAYERS = 30
+
+# Messages per second sent by one client, everyone in view of everyone
+RATES = {"playerposition": 60, "playerhandrotation": 30, "settile": 4}
+
+# Server to client websocket frame header for payloads under 126 bytes
+FRAME_HEADER = 2
+
+CLIENT_HANDLES = {"ABC123": 7}
+MESSAGES = {
+    "playerposition": {"event": "game", "type": "playerposition", "client_id": "ABC123", "data": {"x": 3201.5, "y": 310.25}},
+    "playerhandrotation": {"event": "game", "type": "playerhandrotation", "client_id": "ABC123", "data": 1.5707963},
+    "settile": {"event": "game", "type": "settile", "client_id": "ABC123", "data": {"x": 104, "y": 27, "id": -1}}
+}
+
+
+def per_message(function):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        function()
+    return (time.perf_counter() - start) / ITERATIONS
+
+
+def main():
+    encoders = {"json": None}
+    if protocol.orjson is not None:
+        encoders["orjson"] = protocol.orjson
+
+    totals = {}
+    for name, message in MESSAGES.items():
+        print(name)
+
+        for encoder, module in encoders.items():
+            protocol.orjson = module
+            payload = protocol.encode_message(message)
+            frame = {"bytes": payload}
+
+            encode_time = per_message(lambda: protocol.encode_message(message))
+            parse_time = per_message(lambda: protocol.decode_message(frame))
+            print(f"  {encoder:<7} | {len(payload):>3} bytes | encode {encode_time * 1e6:>5.2f} us | parse {parse_time * 1e6:>5.2f} us")
+            totals.setdefault(encoder, 0)
+            totals[encoder] += (len(payload) + FRAME_HEADER) * RATES[name]
+
+        payload = protocol.encode_binary_message(message, CLIENT_HANDLES)
+        frame = {"bytes": payload}
+        encode_time = per_message(lambda: protocol.encode_binary_message(message, CLIENT_HANDLES))
+        parse_time = per_message(lambda: protocol.decode_message(frame))
+        print(f"  {'binary':<7} | {len(payload):>3} bytes | encode {encode_time * 1e6:>5.2f} us | parse {parse_time * 1e6:>5.2f} us")
+        totals.setdefault("binary", 0)
+        totals["binary"] += (len(payload) + FRAME_HEADER) * RATES[name]
+
+    # Every player receives the hot messages of every other player
+    print(f"\nOutgoing bandwidth with {PLAYERS} players at {json.dumps(RATES)} messages/s each")
+    for encoder, bytes_per_player in totals.items():
+        bytes_per_second = bytes_per_player * PLAYERS * (PLAYERS - 1)
+        print(f"  {encoder:<7} | {bytes_per_second / 1e6:>6.2f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# Per player memory and per message handler cost with 1,000 sessions, the
+# session registry and PlayerState against the dicts and websocket scans
+# ConnectionManager used before. A disconnect used to scan for the
+# websocket five times (disconnect, get_username and get_client_id twice).
+# Run from the repository root: python -m benchmarks.bench_sessions
+
+import asyncio
+import random
+import time
+import tracemalloc
+
+import server
+from players import PlayerState
+
+SESSIONS = 1000
+OPERATIONS = 20_000
+
+
+class FakeWebSocket:
+    pass
+
+
+def player_dict(rng):
+    return {
+        "position": {"x": rng.randrange(6400), "y": rng.randrange(9600)},
+        "inventory": {str(block_id): rng.randrange(1, 64) for block_id in rng.sample(range(64), 12)},
+        "has_flashlight": False,
+        "holding_item": "",
+        "current_drill_level": 0,
+        "money": rng.randrange(10000)
+    }
+
+
+def client_dict(client_id, websocket, position):
+    # A client as ConnectionManager.clients held it before
+    return {
+        "os_uid": client_id,
+        "username": client_id.lower(),
+        "position": position,
+        "websocket": websocket,
+        "snapshots": False,
+        "placed_item_deltas": False,
+        "item_stacks": False,
+        "protocol": "json"
+    }
+
+
+def old_get_client_id(clients, websocket):
+    for client in clients.keys():
+        if clients[client]["websocket"] == websocket:
+            return client
+
+
+def old_update_player_data(clients, player_data, client_id, has_flashlight, holding_item, current_drill_level, money):
+    player_data[clients[client_id]["os_uid"]]["has_flashlight"] = has_flashlight
+    player_data[clients[client_id]["os_uid"]]["holding_item"] = holding_item
+    player_data[clients[client_id]["os_uid"]]["current_drill_level"] = current_drill_level
+    player_data[clients[client_id]["os_uid"]]["money"] = money
+
+    server.record_mutation({"op": "playerdata", "os_uid": clients[client_id]["os_uid"], "data": {
+        "has_flashlight": has_flashlight,
+        "holding_item": holding_item,
+        "current_drill_level": current_drill_level,
+        "money": money
+    }})
+
+
+def old_update_player_inventory(clients, player_data, client_id, block_id, count):
+    if not str(block_id) in player_data[clients[client_id]["os_uid"]]["inventory"]:
+        player_data[clients[client_id]["os_uid"]]["inventory"][str(block_id)] = count
+    else:
+        player_data[clients[client_id]["os_uid"]]["inventory"][str(block_id)] += count
+
+    server.record_mutation({"op": "playerinventory", "os_uid": clients[client_id]["os_uid"], "block_id": block_id, "count": count})
+
+
+def measure_memory(function):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = function()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / SESSIONS, kept
+
+
+def time_per_op(function, operations):
+    start = time.perf_counter()
+    for operation in operations:
+        function(*operation)
+    return (time.perf_counter() - start) / len(operations)
+
+
+async def run():
+    rng = random.Random(1)
+    client_ids = ["client" + str(index) for index in range(SESSIONS)]
+    websockets = [FakeWebSocket() for _ in client_ids]
+    saved_players = {client_id: player_dict(rng) for client_id in client_ids}
+
+    def build_old():
+        players = {client_id: {"position": dict(data["position"]), "inventory": dict(data["inventory"]), "has_flashlight": False, "holding_item": "", "current_drill_level": 0, "money": data["money"]} for client_id, data in saved_players.items()}
+        clients = {client_id: client_dict(client_id, websocket, players[client_id]["position"]) for client_id, websocket in zip(client_ids, websockets)}
+        return clients, players
+
+    def build_new():
+        players = {client_id: PlayerState.from_dict(data) for client_id, data in saved_players.items()}
+        sessions = [server.Session(client_id, client_id, client_id.lower(), websocket, None, players[client_id]) for client_id, websocket in zip(client_ids, websockets)]
+        return sessions, players
+
+    old_memory, (old_clients, old_players) = measure_memory(build_old)
+    new_memory, kept = measure_memory(build_new)
+
+    # The real ConnectionManager, with send queues that never send anything
+    server.PLAYER_DATA = kept[1]
+    manager = server.ConnectionManager()
+    for client_id, websocket in zip(client_ids, websockets):
+        manager.connect(client_id, client_id, client_id.lower(), websocket)
+
+    lookups = [(rng.choice(websockets),) for _ in range(OPERATIONS)]
+    data_updates = [(rng.choice(client_ids), True, "pickaxe", 2, rng.randrange(10000)) for _ in range(OPERATIONS)]
+    inventory_updates = [(rng.choice(client_ids), rng.randrange(64), 1) for _ in range(OPERATIONS)]
+
+    results = [
+        ("bytes per player", old_memory, new_memory, "%10.0f"),
+        ("get_client_id us", time_per_op(lambda websocket: old_get_client_id(old_clients, websocket), lookups) * 1e6, time_per_op(manager.get_client_id, lookups) * 1e6, "%10.3f"),
+        ("update_player_data us", time_per_op(lambda *update: old_update_player_data(old_clients, old_players, *update), data_updates) * 1e6, time_per_op(manager.update_player_data, data_updates) * 1e6, "%10.3f"),
+        ("update_player_inventory us", time_per_op(lambda *update: old_update_player_inventory(old_clients, old_players, *update), inventory_updates) * 1e6, time_per_op(manager.update_player_inventory, inventory_updates) * 1e6, "%10.3f")
+    ]
+
+    print("%d sessions                  before       after" % SESSIONS)
+    for name, before, after, number_format in results:
+        print(("%-26s " + number_format + "  " + number_format) % (name, before, after))
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
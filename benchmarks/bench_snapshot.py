@@ -0,0 +1,160 @@
+# Startup time and peak memory of loading a saved world, JSON (map.json and
+# players.json) against the binary world.bin. A synthetic world is saved
+# in both formats and each one is loaded by load_fs_data in a fresh
+# process, which then encodes the chunks around the spawn point like the
+# first joining player would need.
+#
+# Run from the repository root: python -m benchmarks.bench_snapshot
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.loadgen import REPOSITORY_ROOT, process_usage
+
+
+def peak_rss_mb():
+    # VmHWM starts over on exec, ru_maxrss would include the parent that
+    # built the world
+    usage = process_usage(os.getpid())
+    if usage is not None and usage["peak_rss_mb"] is not None:
+        return round(usage["peak_rss_mb"], 1)
+    return round(process_usage(None)["peak_rss_mb"], 1)
+
+
+def build_world(directory, config):
+    sys.path.insert(0, str(REPOSITORY_ROOT))
+    from tilestore import TileStore
+    from droppeditems import DroppedItemStore
+    from placeditems import PlacedItemStore
+    from players import players_from_dict
+    from snapshot import write_snapshot
+
+    generator = random.Random(1)
+    tiles = TileStore(config.width, config.height)
+    while len(tiles) < config.tiles:
+        tiles.set(generator.randrange(config.width), generator.randrange(config.height), generator.randrange(64))
+
+    dropped_items = DroppedItemStore(despawn_time=0, region_cap=0)
+    for index in range(config.dropped_items):
+        dropped_items.add("d" + str(index), "d" + str(index), generator.randrange(config.width), generator.randrange(config.height), generator.randrange(64))
+
+    players = {}
+    for index in range(config.players):
+        players["player" + str(index)] = {
+            "position": {"x": generator.randrange(config.width * 32), "y": generator.randrange(config.height * 32)},
+            "inventory": {str(block_id): generator.randrange(1, 64) for block_id in generator.sample(range(64), 24)},
+            "has_flashlight": False,
+            "holding_item": "",
+            "current_drill_level": 0,
+            "money": generator.randrange(10000)
+        }
+
+    world = {"map_tiles": tiles, "map_dropped_items": dropped_items, "map_placed_items": PlacedItemStore(), "map_time": 0, "player_data": players_from_dict(players)}
+
+    for snapshot_format in ("json", "binary"):
+        gamedata = Path(directory) / snapshot_format / "gamedata"
+        gamedata.mkdir(parents=True)
+        with open(gamedata.parent / "server.json", "w") as outfile:
+            json.dump({
+                "map_seed": 42069,
+                "map_size": {"x": config.width, "y": config.height},
+                "map_generator_settings": {},
+                "map_poi": {},
+                "player_spawn_point": {"x": config.width * 16, "y": 300},
+                "server_settings": {"snapshot_format": snapshot_format, "persistence": "snapshot"}
+            }, outfile)
+
+        if snapshot_format == "json":
+            with open(gamedata / "map.json", "w") as outfile:
+                json.dump({"map_tiles": tiles.to_list(), "map_dropped_items": dropped_items.to_dict(), "map_placed_items": [], "map_time": 0, "journal_seq": 0}, outfile)
+            with open(gamedata / "players.json", "w") as outfile:
+                json.dump({"player_data": players, "journal_seq": 0}, outfile)
+        else:
+            write_snapshot(str(gamedata / "world.bin"), world, 0, 0)
+
+    sizes = {}
+    for snapshot_format in ("json", "binary"):
+        gamedata = Path(directory) / snapshot_format / "gamedata"
+        sizes[snapshot_format] = round(sum(path.stat().st_size for path in gamedata.iterdir()) / (1024 * 1024), 1)
+    return sizes
+
+
+def load_world():
+    # Runs in the child process, from the directory of one format
+    sys.path.insert(0, str(REPOSITORY_ROOT))
+    import server
+
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    server.load_fs_data()
+    loaded = time.perf_counter()
+
+    spawn = server.PLAYER_SPAWNPOINT
+    for key in server.MAP_TILES.chunks_by_distance(spawn["x"] / server.TILE_SIZE, spawn["y"] / server.TILE_SIZE, 4):
+        server.MAP_TILES.encode_chunk(key)
+    first_chunks = time.perf_counter()
+
+    print(json.dumps({
+        "load_ms": round((loaded - started) * 1000, 1),
+        "first_chunks_ms": round((first_chunks - started) * 1000, 1),
+        "tiles": len(server.MAP_TILES),
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": peak_rss_mb()
+    }))
+
+
+def run_format(directory, snapshot_format):
+    environment = dict(os.environ, PYTHONPATH=str(REPOSITORY_ROOT))
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_snapshot", "--load"],
+        cwd=str(Path(directory) / snapshot_format), env=environment, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and peak memory, JSON against binary world snapshots")
+    parser.add_argument("--width", type=int, default=2000, help="map width in tiles")
+    parser.add_argument("--height", type=int, default=3000, help="map height in tiles")
+    parser.add_argument("--tiles", type=int, default=1000000, help="modified tiles")
+    parser.add_argument("--dropped-items", type=int, default=20000)
+    parser.add_argument("--players", type=int, default=5000)
+    parser.add_argument("--runs", type=int, default=3, help="loads per format, the fastest one is reported")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--load", action="store_true", help=argparse.SUPPRESS)
+    config = parser.parse_args()
+
+    if config.load:
+        load_world()
+        return
+
+    directory = tempfile.mkdtemp(prefix="minecat-snapshot-")
+    try:
+        sizes = build_world(directory, config)
+
+        report = {"world": {"tiles": config.tiles, "dropped_items": config.dropped_items, "players": config.players}, "formats": {}}
+        print("format  size MB  load ms  first chunks ms  peak RSS MB (after imports)")
+        for snapshot_format in ("json", "binary"):
+            runs = [run_format(directory, snapshot_format) for run in range(config.runs)]
+            result = min(runs, key=lambda run: run["load_ms"])
+            result["size_mb"] = sizes[snapshot_format]
+            report["formats"][snapshot_format] = result
+            print("%-6s  %7.1f  %7.1f  %15.1f  %11.1f (%.1f)" % (snapshot_format, result["size_mb"], result["load_ms"], result["first_chunks_ms"], result["peak_rss_mb"], result["baseline_rss_mb"]))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if config.output is not None:
+        with open(config.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
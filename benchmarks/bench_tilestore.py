@@ -0,0 +1,69 @@
+# Compares the indexed TileStore against the old linear MAP_TILES scan.
+# Run from the repository root: python -m benchmarks.bench_tilestore
+
+import random
+import time
+
+from tilestore import TileStore
+
+MAP_WIDTH = 1024
+MAP_HEIGHT = 1024
+TILE_COUNTS = [10_000, 100_000, 1_000_000]
+
+
+def list_settile(map_tiles, x, y, tile_id):
+    # The settile handler as it was before the TileStore
+    already_mined = False
+    save_tile = True
+    for tile in map_tiles:
+        if tile["x"] == x and tile["y"] == y:
+            if tile["id"] == tile_id:
+                already_mined = True
+            else:
+                save_tile = False
+                tile["id"] = tile_id
+
+    if save_tile and not already_mined:
+        map_tiles.append({"x": x, "y": y, "id": tile_id})
+
+
+def time_per_op(function, operations):
+    start = time.perf_counter()
+    for x, y, tile_id in operations:
+        function(x, y, tile_id)
+    return (time.perf_counter() - start) / len(operations)
+
+
+def run(tile_count):
+    rng = random.Random(tile_count)
+    cells = rng.sample(range(MAP_WIDTH * MAP_HEIGHT), tile_count)
+    tiles = [{"x": cell % MAP_WIDTH, "y": cell // MAP_WIDTH, "id": -1} for cell in cells]
+
+    map_tiles = list(tiles)
+    store = TileStore.from_list(MAP_WIDTH, MAP_HEIGHT, tiles)
+
+    # The list scan gets slow quickly, so it only runs a handful of operations
+    list_ops = max(5, 200_000_000 // (tile_count * 1000))
+    store_ops = 100_000
+
+    def random_ops(count):
+        ops = []
+        for _ in range(count):
+            cell = rng.randrange(MAP_WIDTH * MAP_HEIGHT)
+            ops.append((cell % MAP_WIDTH, cell // MAP_WIDTH, rng.choice((-1, 3))))
+        return ops
+
+    start = time.perf_counter()
+    iterated = sum(1 for _ in store)
+    iterate_time = time.perf_counter() - start
+
+    list_time = time_per_op(lambda x, y, tile_id: list_settile(map_tiles, x, y, tile_id), random_ops(list_ops))
+    store_time = time_per_op(store.set, random_ops(store_ops))
+
+    print(f"{tile_count:>9} tiles | list scan {list_time * 1e6:>12.1f} us/op | TileStore {store_time * 1e6:>6.2f} us/op"
+          f" | speedup {list_time / store_time:>9.0f}x | full iteration ({iterated} tiles) {iterate_time * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    for tile_count in TILE_COUNTS:
+        run(tile_count)
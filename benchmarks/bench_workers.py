@@ -0,0 +1,131 @@
+# Connection capacity against the number of front-end workers. For every
+# worker count the server is started with multiworker.py (0 runs plain
+# uvicorn server:app) and loaded with growing numbers of clients. The
+# capacity is the most clients for which every client joined and the p95
+# broadcast latency stayed under --max-latency.
+#
+# Run from the repository root: python -m benchmarks.bench_workers
+# The load generators need CPU too, so run this on a machine with more
+# cores than the largest worker count.
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.loadgen import REPOSITORY_ROOT, free_port
+
+
+def start_server(workers, port):
+    directory = tempfile.mkdtemp(prefix="minecat-workers-")
+    environment = dict(os.environ, PYTHONPATH=str(REPOSITORY_ROOT))
+
+    if workers == 0:
+        command = [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"]
+    else:
+        command = [sys.executable, str(REPOSITORY_ROOT / "multiworker.py"), "--workers", str(workers), "--port", str(port), "--admin-port", str(free_port()), "--log-level", "warning"]
+    process = subprocess.Popen(command, cwd=directory, env=environment)
+
+    # Wait until the workers accept connections
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            time.sleep(1)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("server did not start")
+
+
+def run_step(port, clients, config):
+    # Splits the clients over several load generator processes
+    processes = []
+    outputs = []
+    generators = min(config.generators, clients)
+    offset = 0
+    for generator in range(generators):
+        count = clients // generators + (1 if generator < clients % generators else 0)
+        output = tempfile.mktemp(suffix=".json")
+        outputs.append(output)
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "benchmarks.loadgen",
+            "--url", "ws://127.0.0.1:" + str(port) + "/",
+            "--clients", str(count),
+            "--client-offset", str(offset),
+            "--duration", str(config.duration),
+            "--ramp", str(config.ramp),
+            "--output", output
+        ], cwd=str(REPOSITORY_ROOT), stdout=subprocess.DEVNULL))
+        offset += count
+
+    results = []
+    for process, output in zip(processes, outputs):
+        process.wait()
+        with open(output, "r") as reader:
+            results.append(json.load(reader)["results"])
+        os.unlink(output)
+
+    def worst(metric):
+        values = [result[metric]["p95"] for result in results if result[metric] is not None]
+        return max(values) if len(values) > 0 else None
+
+    return {
+        "clients": clients,
+        "connected": sum(result["clients_connected"] for result in results),
+        "errors": sum(result["errors"] for result in results),
+        "messages_received_per_second": round(sum(result["messages_received_per_second"] for result in results), 1),
+        "broadcast_latency_p95_ms": worst("broadcast_latency_ms"),
+        "movement_latency_p95_ms": worst("movement_latency_ms")
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connection capacity against the number of workers")
+    parser.add_argument("--workers", default="0,1,2,4", help="comma separated worker counts, 0 is a single process server")
+    parser.add_argument("--clients", default="25,50,100,200,400", help="comma separated client counts to try")
+    parser.add_argument("--max-latency", type=float, default=100.0, help="p95 broadcast latency in ms a step may reach")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--ramp", type=float, default=3.0)
+    parser.add_argument("--generators", type=int, default=4, help="load generator processes")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    config = parser.parse_args()
+
+    report = {"cpu_count": os.cpu_count(), "max_latency_ms": config.max_latency, "runs": []}
+    print("workers  capacity  (clients: msgs/s, p95 broadcast ms)")
+
+    for workers in [int(value) for value in config.workers.split(",")]:
+        capacity = 0
+        steps = []
+
+        for clients in [int(value) for value in config.clients.split(",")]:
+            port = free_port()
+            process = start_server(workers, port)
+            try:
+                step = run_step(port, clients, config)
+            finally:
+                process.terminate()
+                process.wait()
+
+            steps.append(step)
+            latency = step["broadcast_latency_p95_ms"]
+            if step["errors"] > 0 or step["connected"] < clients or latency is None or latency > config.max_latency:
+                break
+            capacity = clients
+
+        report["runs"].append({"workers": workers, "capacity": capacity, "steps": steps})
+        summary = ", ".join(str(step["clients"]) + ": " + str(step["messages_received_per_second"]) + ", " + str(step["broadcast_latency_p95_ms"]) for step in steps)
+        print("%7d  %8d  (%s)" % (workers, capacity, summary))
+
+    if config.output is not None:
+        with open(config.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
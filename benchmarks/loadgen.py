@@ -0,0 +1,388 @@
+# Headless load generator for the websocket protocol. Spawns simulated
+# clients that run the real handshake and join flow, then move, mine and
+# drop items at fixed rates while measuring latency.
+#
+# Run from the repository root:
+#   python -m benchmarks.loadgen --clients 50 --duration 30 --output results.json
+#   python -m benchmarks.loadgen --url ws://127.0.0.1:8000/ --server-pid 1234
+#   python -m benchmarks.loadgen --baseline results.json
+#
+# Without --url a local uvicorn is started in a temporary directory, with
+# --in-process the app runs in this process instead.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import websockets
+
+import server
+
+REPOSITORY_ROOT = Path(__file__).resolve().parent.parent
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.received_by_type = {}
+        self.errors = 0
+        self.connected = 0
+        self.join_ms = []
+        self.request_rtt_ms = []
+        self.settile_rtt_ms = []
+        self.broadcast_latency_ms = []
+        self.movement_latency_ms = []
+
+
+class SimulatedClient:
+    def __init__(self, url, index, config, stats):
+        self.url = url
+        self.index = index
+        self.config = config
+        self.stats = stats
+        self.client_id = None
+        self.rng = random.Random(index)
+        self.position = {"x": server.PLAYER_SPAWNPOINT["x"] + self.rng.uniform(-300, 300), "y": server.PLAYER_SPAWNPOINT["y"]}
+        self.waiting = {}
+
+    async def send(self, websocket, message):
+        await websocket.send(json.dumps(message).encode("utf-8"))
+        self.stats.sent += 1
+
+    async def request(self, websocket, message, response_type):
+        # Sends a request and waits until the receiver sees response_type
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[response_type] = future
+        start = time.perf_counter()
+        await self.send(websocket, message)
+        await asyncio.wait_for(future, self.config.timeout)
+        return (time.perf_counter() - start) * 1000
+
+    async def run(self, stop_at):
+        try:
+            async with websockets.connect(self.url, max_size=None) as websocket:
+                receiver = asyncio.get_running_loop().create_task(self.receive(websocket))
+                try:
+                    await self.join(websocket)
+                    self.stats.connected += 1
+                    await asyncio.gather(
+                        self.every(self.config.move_rate, stop_at, lambda: self.move(websocket)),
+                        self.every(self.config.mine_rate, stop_at, lambda: self.mine(websocket)),
+                        self.every(self.config.drop_rate, stop_at, lambda: self.drop(websocket))
+                    )
+                finally:
+                    receiver.cancel()
+        except Exception as exception:
+            self.stats.errors += 1
+            print("client " + str(self.index) + " failed: " + repr(exception), file=sys.stderr)
+
+    async def join(self, websocket):
+        start = time.perf_counter()
+
+        await self.request(websocket, {"event": "handshake", "type": "requestid"}, "responseid")
+        await self.request(websocket, {
+            "event": "handshake",
+            "type": "requestconnect",
+            "client_id": self.client_id,
+            "username": "loadgen" + str(self.index),
+            "os_uid": "loadgen" + str(self.index),
+            "game_version": server.SERVER_GAME_VERSION
+        }, "responseconnect")
+
+        self.stats.request_rtt_ms.append(await self.request(websocket, {"event": "game", "type": "requestmapdata", "client_id": self.client_id}, "responsemapdata"))
+
+        # Replies arrive in order, responseclients marks the end of the map downloads
+        await self.send(websocket, {"event": "game", "type": "requestmaptiles", "client_id": self.client_id})
+        await self.send(websocket, {"event": "game", "type": "requestmapdroppeditems", "client_id": self.client_id})
+        await self.request(websocket, {"event": "game", "type": "requestclients", "client_id": self.client_id}, "responseclients")
+
+        self.stats.join_ms.append((time.perf_counter() - start) * 1000)
+
+    async def every(self, rate, stop_at, action):
+        if rate <= 0:
+            return
+
+        interval = 1.0 / rate
+        # Spread clients over the interval instead of sending in lockstep
+        await asyncio.sleep(self.rng.uniform(0, interval))
+        while time.monotonic() < stop_at:
+            await action()
+            await asyncio.sleep(interval)
+
+    async def move(self, websocket):
+        self.position["x"] += self.rng.uniform(-8, 8)
+        self.position["y"] += self.rng.uniform(-4, 4)
+        await self.send(websocket, {"event": "game", "type": "playerposition", "client_id": self.client_id, "data": {
+            "x": self.position["x"],
+            "y": self.position["y"],
+            "sent_at": time.time()
+        }})
+
+    async def mine(self, websocket):
+        await self.send(websocket, {"event": "game", "type": "settile", "client_id": self.client_id, "data": {
+            "x": self.rng.randrange(server.MAP_SIZE["x"]),
+            "y": self.rng.randrange(server.MAP_SIZE["y"]),
+            "id": -1,
+            "sent_at": time.time()
+        }})
+
+    async def drop(self, websocket):
+        await self.send(websocket, {"event": "game", "type": "dropitem", "client_id": self.client_id, "data": {
+            "x": self.rng.randrange(server.MAP_SIZE["x"]),
+            "y": self.rng.randrange(server.MAP_SIZE["y"]),
+            "id": self.rng.randrange(1, 10)
+        }})
+
+    async def receive(self, websocket):
+        async for frame in websocket:
+            now = time.time()
+            message = json.loads(frame)
+            message_type = message.get("type", "")
+
+            self.stats.received += 1
+            self.stats.received_by_type[message_type] = self.stats.received_by_type.get(message_type, 0) + 1
+
+            if message_type == "responseid":
+                self.client_id = message["data"]
+
+            if message_type == "settile" and isinstance(message.get("data"), dict) and "sent_at" in message["data"]:
+                latency = (now - message["data"]["sent_at"]) * 1000
+                if message.get("client_id") == self.client_id:
+                    self.stats.settile_rtt_ms.append(latency)
+                else:
+                    self.stats.broadcast_latency_ms.append(latency)
+
+            if message_type == "playerposition" and message.get("client_id") != self.client_id:
+                if isinstance(message.get("data"), dict) and "sent_at" in message["data"]:
+                    self.stats.movement_latency_ms.append((now - message["data"]["sent_at"]) * 1000)
+
+            if message_type == "snapshot":
+                for client_id, changes in message["data"]["players"].items():
+                    if client_id != self.client_id and "position" in changes and "sent_at" in changes["position"]:
+                        self.stats.movement_latency_ms.append((now - changes["position"]["sent_at"]) * 1000)
+
+            future = self.waiting.pop(message_type, None)
+            if future is not None and not future.done():
+                future.set_result(message)
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+
+    def percentile(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))], 3)
+
+    return {"count": len(values), "p50": percentile(0.50), "p95": percentile(0.95), "p99": percentile(0.99), "max": round(values[-1], 3)}
+
+
+def process_usage(pid):
+    # CPU seconds and memory of a process, from /proc on Linux
+    if pid is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {"cpu_seconds": usage.ru_utime + usage.ru_stime, "rss_mb": None, "peak_rss_mb": usage.ru_maxrss / 1024}
+
+    try:
+        stat = Path("/proc/" + str(pid) + "/stat").read_text().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        usage = {"cpu_seconds": (int(stat[11]) + int(stat[12])) / ticks, "rss_mb": None, "peak_rss_mb": None}
+
+        for line in Path("/proc/" + str(pid) + "/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                usage["rss_mb"] = int(line.split()[1]) / 1024
+            if line.startswith("VmHWM:"):
+                usage["peak_rss_mb"] = int(line.split()[1]) / 1024
+        return usage
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def fetch_json(url):
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_port(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start on port " + str(port))
+
+
+async def run_load(url, server_pid, config):
+    stats = Stats()
+    http_url = url.replace("ws://", "http://").rstrip("/")
+
+    usage_before = process_usage(server_pid)
+    start = time.monotonic()
+    stop_at = start + config.ramp + config.duration
+
+    clients = []
+    for index in range(config.clients):
+        client = SimulatedClient(url, config.client_offset + index, config, stats)
+        clients.append(asyncio.get_running_loop().create_task(client.run(stop_at)))
+        if config.ramp > 0:
+            await asyncio.sleep(config.ramp / config.clients)
+
+    await asyncio.gather(*clients)
+    elapsed = time.monotonic() - start
+    usage_after = process_usage(server_pid)
+
+    server_usage = None
+    if usage_before is not None and usage_after is not None:
+        server_usage = {
+            "cpu_percent": round((usage_after["cpu_seconds"] - usage_before["cpu_seconds"]) / elapsed * 100, 1),
+            "rss_mb": usage_after["rss_mb"],
+            "peak_rss_mb": usage_after["peak_rss_mb"],
+            "includes_clients": server_pid is None
+        }
+
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "clients_connected": stats.connected,
+        "errors": stats.errors,
+        "messages_sent": stats.sent,
+        "messages_received": stats.received,
+        "messages_sent_per_second": round(stats.sent / elapsed, 1),
+        "messages_received_per_second": round(stats.received / elapsed, 1),
+        "messages_received_by_type": stats.received_by_type,
+        "join_ms": percentiles(stats.join_ms),
+        "request_rtt_ms": percentiles(stats.request_rtt_ms),
+        "settile_rtt_ms": percentiles(stats.settile_rtt_ms),
+        "broadcast_latency_ms": percentiles(stats.broadcast_latency_ms),
+        "movement_latency_ms": percentiles(stats.movement_latency_ms),
+        "server": server_usage,
+        "server_tick": fetch_json(http_url + "/stats/tick")
+    }
+
+
+async def run_in_process(config):
+    import uvicorn
+
+    port = free_port()
+    os.chdir(tempfile.mkdtemp(prefix="minecat-loadgen-"))
+
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    serve_task = asyncio.get_running_loop().create_task(uvicorn_server.serve())
+    await wait_for_port(port)
+
+    try:
+        return await run_load("ws://127.0.0.1:" + str(port) + "/", None, config)
+    finally:
+        uvicorn_server.should_exit = True
+        await serve_task
+
+
+async def run_subprocess(config):
+    port = free_port()
+    environment = dict(os.environ, PYTHONPATH=str(REPOSITORY_ROOT))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=tempfile.mkdtemp(prefix="minecat-loadgen-"),
+        env=environment
+    )
+
+    try:
+        await wait_for_port(port)
+        return await run_load("ws://127.0.0.1:" + str(port) + "/", process.pid, config)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def compare(results, baseline, tolerance):
+    # Returns the metrics that got worse by more than tolerance
+    regressions = []
+
+    def check(name, current, previous, higher_is_better):
+        if current is None or previous is None or previous == 0:
+            return
+        change = (current - previous) / previous
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(name + ": " + str(previous) + " -> " + str(current))
+
+    check("messages_received_per_second", results["messages_received_per_second"], baseline["messages_received_per_second"], True)
+    for metric in ("join_ms", "request_rtt_ms", "settile_rtt_ms", "broadcast_latency_ms", "movement_latency_ms"):
+        for percentile in ("p50", "p95", "p99"):
+            if results.get(metric) and baseline.get(metric):
+                check(metric + "." + percentile, results[metric][percentile], baseline[metric][percentile], False)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minecat server load generator")
+    parser.add_argument("--url", help="websocket url of a running server, a local one is started when omitted")
+    parser.add_argument("--server-pid", type=int, help="pid of the server given with --url, for CPU and memory")
+    parser.add_argument("--in-process", action="store_true", help="run the app in this process instead of a uvicorn subprocess")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--client-offset", type=int, default=0, help="number of the first client, to run several load generators at once")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of steady state traffic")
+    parser.add_argument("--ramp", type=float, default=2.0, help="seconds over which clients connect")
+    parser.add_argument("--move-rate", type=float, default=20.0, help="playerposition messages per second per client")
+    parser.add_argument("--mine-rate", type=float, default=2.0, help="settile messages per second per client")
+    parser.add_argument("--drop-rate", type=float, default=0.5, help="dropitem messages per second per client")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for a response")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against an earlier results file, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative change before a metric counts as a regression")
+    config = parser.parse_args()
+
+    if config.url is not None:
+        results = asyncio.run(run_load(config.url, config.server_pid, config))
+    elif config.in_process:
+        results = asyncio.run(run_in_process(config))
+    else:
+        results = asyncio.run(run_subprocess(config))
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "game_version": server.SERVER_GAME_VERSION,
+        "config": {key: value for key, value in vars(config).items() if key not in ("output", "baseline")},
+        "results": results
+    }
+    print(json.dumps(report, indent=2))
+
+    if config.output is not None:
+        with open(config.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+    if config.baseline is not None:
+        with open(config.baseline, "r") as reader:
+            baseline = json.load(reader)["results"]
+
+        regressions = compare(results, baseline, config.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
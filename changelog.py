@@ -0,0 +1,43 @@
+from collections import deque
+
+class ChangeLog:
+    # The most recent world changes as (revision, kind, key), so clients
+    # that reconnect can be sent what changed since the revision they last
+    # saw instead of the whole world. Only keys are kept, the current
+    # values are looked up when the changes are sent.
+
+    def __init__(self, revision=0, size=20000):
+        self.revision = revision
+        # Clients at this revision or later can still get a delta
+        self.first_revision = revision
+        self.size = size
+        self.entries = deque()
+
+    def record(self, changes):
+        # changes is a list of (kind, key), all recorded under one revision
+        self.revision += 1
+        for kind, key in changes:
+            self.entries.append((self.revision, kind, key))
+
+        while len(self.entries) > self.size:
+            self.first_revision = self.entries.popleft()[0]
+        return self.revision
+
+    def changes_since(self, revision):
+        # {kind: [key, ...]} of everything changed after revision, oldest
+        # first, or None when the log doesn't reach back that far
+        if revision < self.first_revision or revision > self.revision:
+            return None
+
+        changes = {}
+        seen = set()
+        for entry_revision, kind, key in reversed(self.entries):
+            if entry_revision <= revision:
+                break
+            if (kind, key) not in seen:
+                seen.add((kind, key))
+                changes.setdefault(kind, []).append(key)
+
+        for keys in changes.values():
+            keys.reverse()
+        return changes
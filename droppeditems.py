@@ -0,0 +1,163 @@
+import heapq
+import time
+
+class DroppedItemStore:
+    # Dropped items, grouped into stacks of identical items on the same
+    # tile. A stack is keyed by the uid of its first item and remembers the
+    # uids of all its items ("units") for clients that don't know about
+    # stacks. Stacks are also indexed by region, for nearest first downloads
+    # and the per region cap, and their despawn times are kept in a heap so
+    # each tick only looks at the items that are due.
+
+    def __init__(self, region_size=16, region_cap=256, max_stack=64, despawn_time=300.0):
+        self.region_size = region_size
+        self.region_cap = region_cap
+        self.max_stack = max_stack
+        self.despawn_time = despawn_time
+        self.stacks = {}
+        self.tiles = {}
+        self.units = {}
+        self.regions = {}
+        self.despawn_queue = []
+
+    @classmethod
+    def from_dict(cls, items, region_size=16, region_cap=256, max_stack=64, despawn_time=300.0):
+        # Also reads the old format, one {"x", "y", "id"} entry per item
+        store = cls(region_size, region_cap, max_stack, despawn_time)
+        for uid, item in items.items():
+            for unit_uid in item.get("units", [uid]):
+                store.add(uid, unit_uid, item["x"], item["y"], item["id"], item.get("despawn_at"))
+        return store
+
+    def __len__(self):
+        return len(self.stacks)
+
+    def __contains__(self, uid):
+        return uid in self.stacks or uid in self.units
+
+    def region_key(self, x, y):
+        return int(x) // self.region_size, int(y) // self.region_size
+
+    def get(self, uid):
+        return self.stacks.get(uid)
+
+    def drop(self, unit_uid, x, y, item_id, now):
+        # Adds one item, merging it into a stack on the same tile if there
+        # is room. Returns the stack uid, whether it merged and the stacks
+        # that were removed to stay under the region cap.
+        stack_uid = self.tiles.get((x, y, item_id))
+        if stack_uid is not None and len(self.stacks[stack_uid]["units"]) < self.max_stack:
+            self.add(stack_uid, unit_uid, x, y, item_id, self.despawn_at(now))
+            return stack_uid, True, []
+
+        evicted = []
+        region = self.regions.get(self.region_key(x, y))
+        if self.region_cap > 0 and region is not None and len(region) >= self.region_cap:
+            # Regions keep insertion order, the first stack is the oldest
+            oldest_uid = next(iter(region))
+            evicted.append((oldest_uid, self.remove_stack(oldest_uid)))
+
+        self.add(unit_uid, unit_uid, x, y, item_id, self.despawn_at(now))
+        return unit_uid, False, evicted
+
+    def despawn_at(self, now):
+        return now + self.despawn_time if self.despawn_time > 0 else None
+
+    def add(self, stack_uid, unit_uid, x, y, item_id, despawn_at=None):
+        stack = self.stacks.get(stack_uid)
+        if stack is None:
+            stack = {"x": x, "y": y, "id": item_id, "units": [], "despawn_at": None}
+            self.stacks[stack_uid] = stack
+            self.tiles[(x, y, item_id)] = stack_uid
+            self.regions.setdefault(self.region_key(x, y), {})[stack_uid] = None
+
+        stack["units"].append(unit_uid)
+        self.units[unit_uid] = stack_uid
+
+        if despawn_at is None:
+            despawn_at = self.despawn_at(time.time())
+        if despawn_at is not None:
+            # A new item restarts the despawn timer of its stack, the old
+            # heap entry is skipped once it comes up
+            stack["despawn_at"] = despawn_at
+            heapq.heappush(self.despawn_queue, (despawn_at, stack_uid))
+            if len(self.despawn_queue) > 2 * len(self.stacks) + 64:
+                self.rebuild_despawn_queue()
+        return stack
+
+    def remove_stack(self, stack_uid):
+        stack = self.stacks.pop(stack_uid, None)
+        if stack is None:
+            return None
+
+        tile_key = (stack["x"], stack["y"], stack["id"])
+        if self.tiles.get(tile_key) == stack_uid:
+            self.tiles.pop(tile_key)
+
+        region_key = self.region_key(stack["x"], stack["y"])
+        region = self.regions[region_key]
+        region.pop(stack_uid)
+        if len(region) == 0:
+            self.regions.pop(region_key)
+
+        for unit_uid in stack["units"]:
+            self.units.pop(unit_uid, None)
+        return stack
+
+    def remove_unit(self, unit_uid):
+        # Removes one item, returns (stack uid, stack) or None. The stack is
+        # removed too once its last item is gone.
+        stack_uid = self.units.pop(unit_uid, None)
+        if stack_uid is None:
+            return None
+
+        stack = self.stacks[stack_uid]
+        stack["units"].remove(unit_uid)
+        if len(stack["units"]) == 0:
+            self.remove_stack(stack_uid)
+        return stack_uid, stack
+
+    def expire(self, now):
+        # Removes and returns the (uid, stack) pairs whose time is up
+        expired = []
+        if self.despawn_time <= 0:
+            return expired
+
+        queue = self.despawn_queue
+        while len(queue) > 0 and queue[0][0] <= now:
+            despawn_at, stack_uid = heapq.heappop(queue)
+            stack = self.stacks.get(stack_uid)
+            if stack is not None and stack["despawn_at"] == despawn_at:
+                expired.append((stack_uid, self.remove_stack(stack_uid)))
+        return expired
+
+    def rebuild_despawn_queue(self):
+        self.despawn_queue = [(stack["despawn_at"], stack_uid) for stack_uid, stack in self.stacks.items() if stack["despawn_at"] is not None]
+        heapq.heapify(self.despawn_queue)
+
+    def nearest(self, x, y, radius=None):
+        # (uid, stack) pairs, regions nearest to tile (x, y) first. radius
+        # is in regions.
+        center_x, center_y = self.region_key(x, y)
+
+        def distance(key):
+            return max(abs(key[0] - center_x), abs(key[1] - center_y))
+
+        found = []
+        for key in sorted(self.regions.keys(), key=distance):
+            if radius is not None and distance(key) > radius:
+                break
+            for stack_uid in self.regions[key]:
+                found.append((stack_uid, self.stacks[stack_uid]))
+        return found
+
+    def to_dict(self):
+        return self.stacks
+
+def stack_data(stack_uid, stack):
+    # A stack as sent to clients that asked for item_stacks
+    return {"x": stack["x"], "y": stack["y"], "id": stack["id"], "uid": stack_uid, "count": len(stack["units"])}
+
+def unit_data(unit_uid, stack):
+    # A single item as sent to other clients
+    return {"x": stack["x"], "y": stack["y"], "id": stack["id"], "uid": unit_uid}
@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import os
+import struct
+
+from protocol import OP_PLAYERHANDROTATION, OP_PLAYERPOSITION, OP_SETTILE, decode_message
+
+# Local link between front-end workers (worker.py) and the state owner
+# (server.py). Frames are handled as tuples:
+#
+#   worker -> owner   ("open", connection_id)
+#                     ("message", connection_id, decoded message, websocket frame)
+#                     ("close", connection_id, code)
+#   owner -> worker   ("send", [connection_id, ...], payload, mode)
+#                     ("close", connection_id, code)
+#
+# On the socket every frame is FRAME_HEADER (body length, kind) and a
+# fixed layout body, payloads as they are sent. No pickle, a frame can't
+# do more than the tuple it stands for.
+#
+# The worker has already decoded and checked every message. Binary
+# protocol frames are passed on as they came in, JSON movement as a
+# MOVEMENT_FRAME, so the owner doesn't parse JSON for the hot messages.
+# Other messages are passed on as the client sent them and decoded the
+# same way again.
+
+FRAME_HEADER = struct.Struct("<IB")
+
+KIND_OPEN = 1
+KIND_MESSAGE = 2
+KIND_CLOSE = 3
+KIND_SEND = 4
+KIND_BINARY = 5
+KIND_MOVEMENT = 6
+
+CONNECTION_ID = struct.Struct("<Q")
+CLOSE_FRAME = struct.Struct("<QI") # connection id, close code
+SEND_FRAME = struct.Struct("<BI") # text (1) or bytes (0), number of connection ids
+MOVEMENT_FRAME = struct.Struct("<QBBdd") # connection id, opcode, which of x (1) and y (2) are ints, x, y, then the client_id
+
+BINARY_OPCODES = (OP_PLAYERPOSITION, OP_PLAYERHANDROTATION, OP_SETTILE)
+
+# Integers a double holds exactly
+MAX_EXACT_INTEGER = 2 ** 53
+
+# Pause writers once this much is buffered for one link
+LINK_HIGH_WATER = 4 * 1024 * 1024
+
+logger = logging.getLogger("uvicorn.info")
+
+async def read_frame(reader):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    length, kind = FRAME_HEADER.unpack(header)
+    body = await reader.readexactly(length)
+
+    if kind == KIND_OPEN:
+        return ("open", CONNECTION_ID.unpack(body)[0])
+    if kind == KIND_MESSAGE:
+        return ("message", CONNECTION_ID.unpack_from(body)[0], decode_message({"text": body[CONNECTION_ID.size:].decode("utf-8")}))
+    if kind == KIND_BINARY:
+        return ("message", CONNECTION_ID.unpack_from(body)[0], decode_message({"bytes": body[CONNECTION_ID.size:]}))
+    if kind == KIND_MOVEMENT:
+        connection_id, opcode, ints, x, y = MOVEMENT_FRAME.unpack_from(body)
+        if ints & 1:
+            x = int(x)
+        if ints & 2:
+            y = int(y)
+        client_id = body[MOVEMENT_FRAME.size:].decode("utf-8")
+        if opcode == OP_PLAYERPOSITION:
+            return ("message", connection_id, {"event": "game", "type": "playerposition", "client_id": client_id, "data": {"x": x, "y": y}})
+        return ("message", connection_id, {"event": "game", "type": "playerhandrotation", "client_id": client_id, "data": x})
+    if kind == KIND_CLOSE:
+        return ("close",) + CLOSE_FRAME.unpack(body)
+    if kind == KIND_SEND:
+        text, count = SEND_FRAME.unpack_from(body)
+        offset = SEND_FRAME.size + count * CONNECTION_ID.size
+        connection_ids = list(struct.unpack_from("<" + str(count) + "Q", body, SEND_FRAME.size))
+        payload = body[offset:]
+        if text:
+            return ("send", connection_ids, payload.decode("utf-8"), "text")
+        return ("send", connection_ids, payload, "bytes")
+    raise ConnectionError("Unknown IPC frame kind " + str(kind))
+
+def write_frame(writer, message):
+    kind = message[0]
+    if kind == "open":
+        body = CONNECTION_ID.pack(message[1])
+        kind = KIND_OPEN
+    elif kind == "message":
+        _, connection_id, data, frame = message
+        payload = frame.get("bytes")
+        movement = movement_values(data)
+        if payload is not None and len(payload) > 0 and payload[0] in BINARY_OPCODES:
+            body = CONNECTION_ID.pack(connection_id) + payload
+            kind = KIND_BINARY
+        elif movement is not None:
+            opcode, ints, x, y = movement
+            body = MOVEMENT_FRAME.pack(connection_id, opcode, ints, x, y) + data["client_id"].encode("utf-8")
+            kind = KIND_MOVEMENT
+        elif payload is not None:
+            body = CONNECTION_ID.pack(connection_id) + payload
+            kind = KIND_BINARY
+        else:
+            body = CONNECTION_ID.pack(connection_id) + frame["text"].encode("utf-8")
+            kind = KIND_MESSAGE
+    elif kind == "close":
+        body = CLOSE_FRAME.pack(message[1], message[2])
+        kind = KIND_CLOSE
+    elif kind == "send":
+        _, connection_ids, payload, mode = message
+        if mode == "text":
+            payload = payload.encode("utf-8")
+        body = SEND_FRAME.pack(mode == "text", len(connection_ids)) + struct.pack("<" + str(len(connection_ids)) + "Q", *connection_ids) + payload
+        kind = KIND_SEND
+    else:
+        raise ValueError("Unknown IPC frame " + repr(kind))
+    writer.write(FRAME_HEADER.pack(len(body), kind) + body)
+
+def movement_values(data):
+    # (opcode, ints, x, y) for a JSON playerposition or playerhandrotation
+    # that MOVEMENT_FRAME carries unchanged, None for any other message
+    if type(data) is not dict or len(data) != 4 or data.get("event") != "game" or type(data.get("client_id")) is not str:
+        return None
+
+    if data.get("type") == "playerposition":
+        position = data.get("data")
+        if type(position) is not dict or len(position) != 2:
+            return None
+        opcode = OP_PLAYERPOSITION
+        values = (position.get("x"), position.get("y"))
+    elif data.get("type") == "playerhandrotation":
+        opcode = OP_PLAYERHANDROTATION
+        values = (data.get("data"), 0)
+    else:
+        return None
+
+    ints = 0
+    for bit, value in ((1, values[0]), (2, values[1])):
+        if type(value) is int:
+            if abs(value) > MAX_EXACT_INTEGER:
+                return None
+            ints |= bit
+        elif type(value) is not float:
+            return None
+    return opcode, ints, values[0], values[1]
+
+class WorkerLink:
+    # Owner side of the connection to one worker. Sends of the same payload
+    # within one event loop iteration are merged into a single "send" frame
+    # so a broadcast crosses the link once per worker, not once per client.
+    # A connection only joins a frame that comes after all of its earlier
+    # ones, so its messages keep their order.
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.websockets = {}
+        # Frames in the order they are written: [payload, mode, connection ids]
+        self.pending = []
+        # id(payload) -> index of its latest frame in pending
+        self.pending_payloads = {}
+        # connection_id -> index of its latest frame in pending
+        self.pending_connections = {}
+        self.flush_scheduled = False
+        self.closed = False
+
+    def send(self, connection_id, payload, mode):
+        if self.closed:
+            return
+
+        index = self.pending_payloads.get(id(payload))
+        if index is None or self.pending_connections.get(connection_id, -1) > index:
+            index = len(self.pending)
+            self.pending.append((payload, mode, [connection_id]))
+            self.pending_payloads[id(payload)] = index
+        else:
+            self.pending[index][2].append(connection_id)
+        self.pending_connections[connection_id] = index
+
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def send_control(self, message):
+        # After the sends before it, a close must not overtake them
+        self.flush()
+        if not self.closed:
+            write_frame(self.writer, message)
+
+    def flush(self):
+        self.flush_scheduled = False
+        pending = self.pending
+        self.pending = []
+        self.pending_payloads = {}
+        self.pending_connections = {}
+
+        if self.closed:
+            return
+
+        for payload, mode, connection_ids in pending:
+            write_frame(self.writer, ("send", connection_ids, payload, mode))
+
+    async def drain(self):
+        # Backpressure for the per client writer tasks
+        if not self.closed and self.writer.transport.get_write_buffer_size() > LINK_HIGH_WATER:
+            await self.writer.drain()
+
+class RemoteWebSocket:
+    # Stands in for a starlette WebSocket whose socket lives in a worker,
+    # so websocket_endpoint and ConnectionManager work unchanged
+
+    def __init__(self, link, connection_id):
+        self.link = link
+        self.connection_id = connection_id
+        self.frames = asyncio.Queue()
+
+    async def accept(self):
+        pass
+
+    async def receive(self):
+        return await self.frames.get()
+
+    async def send_bytes(self, payload):
+        self.link.send(self.connection_id, payload, "bytes")
+        await self.link.drain()
+
+    async def send_text(self, payload):
+        self.link.send(self.connection_id, payload, "text")
+        await self.link.drain()
+
+    async def close(self, code=1000):
+        self.link.send_control(("close", self.connection_id, code))
+
+async def serve_workers(path, endpoint):
+    # Runs endpoint(websocket) for every connection a worker forwards
+    async def handle_worker(reader, writer):
+        link = WorkerLink(reader, writer)
+        tasks = set()
+        logger.info("Worker connected")
+
+        try:
+            while True:
+                message = await read_frame(reader)
+                kind = message[0]
+                connection_id = message[1]
+
+                if kind == "open":
+                    websocket = RemoteWebSocket(link, connection_id)
+                    link.websockets[connection_id] = websocket
+                    task = asyncio.get_running_loop().create_task(endpoint(websocket))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                elif kind == "message":
+                    if connection_id in link.websockets:
+                        link.websockets[connection_id].frames.put_nowait({"type": "websocket.receive", "decoded": message[2]})
+
+                elif kind == "close":
+                    websocket = link.websockets.pop(connection_id, None)
+                    if websocket is not None:
+                        websocket.frames.put_nowait({"type": "websocket.disconnect", "code": message[2]})
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning("Worker disconnected, dropping its " + str(len(link.websockets)) + " connections")
+        finally:
+            link.closed = True
+            for websocket in link.websockets.values():
+                websocket.frames.put_nowait({"type": "websocket.disconnect", "code": 1012})
+            link.websockets.clear()
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle_worker, path)
+    # Only processes of the same user may link up as a worker
+    os.chmod(path, 0o600)
+    return server
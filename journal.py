@@ -0,0 +1,185 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+
+from players import PlayerState
+
+MAP_OPS = ("settile", "dropitem", "removedroppeditem", "removedroppedunit", "addplaceditem", "removeplaceditem", "addchestitem", "maptime")
+PLAYER_OPS = ("playerjoin", "playerposition", "playerinventory", "playerdata")
+
+class Journal:
+    # Append-only log of world mutations. Entries are serialized when they
+    # are appended and written by a background task in batches, with one
+    # fsync per batch. Every entry carries a sequence number so replaying
+    # can skip what a snapshot already contains.
+
+    def __init__(self, path, seq=0, flush_interval=0.2):
+        self.path = Path(path)
+        self.compacting_path = self.path.with_suffix(".compacting" + self.path.suffix)
+        self.seq = seq
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.superseded = {}
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.lock = asyncio.Lock()
+        self.stats = {"appended": 0, "coalesced": 0, "written": 0, "flushes": 0}
+
+    def append(self, entry, coalesce_key=None):
+        # Entries with the same coalesce_key replace each other until written
+        self.seq += 1
+        entry["seq"] = self.seq
+        line = json.dumps(entry) + "\n"
+
+        if coalesce_key is not None:
+            previous_seq = self.superseded.get(coalesce_key)
+            if previous_seq is not None and previous_seq in self.pending:
+                del self.pending[previous_seq]
+                self.stats["coalesced"] += 1
+            self.superseded[coalesce_key] = self.seq
+
+        self.pending[self.seq] = line
+        self.stats["appended"] += 1
+
+    def take_pending(self):
+        lines = "".join(self.pending.values())
+        self.stats["written"] += len(self.pending)
+        self.pending = {}
+        self.superseded = {}
+        return lines
+
+    def write(self, lines):
+        self.file.write(lines)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    async def flush(self):
+        async with self.lock:
+            await self.flush_locked()
+
+    async def flush_locked(self):
+        if len(self.pending) == 0:
+            return
+
+        lines = self.take_pending()
+        self.stats["flushes"] += 1
+        await asyncio.get_running_loop().run_in_executor(None, self.write, lines)
+
+    def flush_now(self):
+        # Blocking flush for shutdown
+        if len(self.pending) > 0:
+            self.write(self.take_pending())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def compact(self, compact_function):
+        # Moves the current log aside and lets compact_function(path) fold
+        # it into the snapshot in a worker thread, new entries keep going to
+        # a fresh log in the meantime
+        async with self.lock:
+            await self.flush_locked()
+            self.file.close()
+
+            if self.compacting_path.exists():
+                # A previous compaction failed, keep its entries in front
+                with open(self.compacting_path, "a", encoding="utf-8") as compacting_file:
+                    compacting_file.write(self.path.read_text(encoding="utf-8"))
+                self.path.unlink()
+            else:
+                os.replace(self.path, self.compacting_path)
+
+            self.file = open(self.path, "a", encoding="utf-8")
+
+        await asyncio.get_running_loop().run_in_executor(None, compact_function, self.compacting_path)
+
+    def truncate(self):
+        # Only call once everything in the log is in a snapshot
+        self.pending = {}
+        self.superseded = {}
+        self.file.close()
+        self.file = open(self.path, "w", encoding="utf-8")
+        if self.compacting_path.exists():
+            self.compacting_path.unlink()
+
+    def close(self):
+        self.file.close()
+
+def read_entries(path):
+    # A crash can leave a partial last line behind, which is skipped
+    path = Path(path)
+    if not path.exists():
+        return
+
+    with open(path, "r", encoding="utf-8") as reader:
+        for line in reader:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def replay(world, paths, map_seq=0, player_seq=0):
+    # Applies all entries newer than the snapshot, returns the last seq seen
+    last_seq = max(map_seq, player_seq)
+    for path in paths:
+        for entry in read_entries(path):
+            seq = entry["seq"]
+            last_seq = max(last_seq, seq)
+
+            if entry["op"] in MAP_OPS and seq <= map_seq:
+                continue
+            if entry["op"] in PLAYER_OPS and seq <= player_seq:
+                continue
+
+            apply_entry(world, entry)
+    return last_seq
+
+def apply_entry(world, entry):
+    # world holds the map.json and players.json fields, with map_tiles as a
+    # TileStore, map_dropped_items as a DroppedItemStore, map_placed_items
+    # as a PlacedItemStore and player_data as PlayerStates
+    op = entry["op"]
+
+    if op == "settile":
+        world["map_tiles"].set(entry["x"], entry["y"], entry["id"])
+
+    elif op == "dropitem":
+        # Entries from before stacks have no stack, the item was its own
+        stack_uid = entry["stack"] if "stack" in entry else entry["uid"]
+        world["map_dropped_items"].add(stack_uid, entry["uid"], entry["x"], entry["y"], entry["id"], entry.get("despawn_at"))
+
+    elif op == "removedroppeditem":
+        world["map_dropped_items"].remove_stack(entry["uid"])
+
+    elif op == "removedroppedunit":
+        world["map_dropped_items"].remove_unit(entry["uid"])
+
+    elif op == "addplaceditem":
+        world["map_placed_items"].add(entry["item"])
+
+    elif op == "removeplaceditem":
+        world["map_placed_items"].remove(entry["x"], entry["y"])
+
+    elif op == "addchestitem":
+        world["map_placed_items"].add_chest_item(entry["chest_id"], entry["block_id"], entry["count"])
+
+    elif op == "maptime":
+        world["map_time"] = entry["time"]
+
+    elif op == "playerjoin":
+        if not entry["os_uid"] in world["player_data"]:
+            world["player_data"][entry["os_uid"]] = PlayerState.from_dict(entry["data"])
+
+    elif entry["os_uid"] in world["player_data"]:
+        player = world["player_data"][entry["os_uid"]]
+
+        if op == "playerposition":
+            player.position = entry["position"]
+
+        elif op == "playerinventory":
+            player.inventory.add(entry["block_id"], entry["count"])
+
+        elif op == "playerdata":
+            player.update(entry["data"])
@@ -0,0 +1,129 @@
+from bisect import bisect_left
+import math
+
+# Seconds, from half a millisecond up to a second
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Label values come from clients, so each metric only keeps this many
+# series and counts the rest under "other"
+MAX_SERIES = 256
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, label_values=(), amount=1):
+        values = self.values
+        if label_values in values:
+            values[label_values] += amount
+        elif len(values) < MAX_SERIES:
+            values[label_values] = amount
+        else:
+            other = ("other",) * len(self.labels)
+            values[other] = values.get(other, 0) + amount
+
+    def render(self, lines):
+        lines.append("# HELP " + self.name + " " + self.help)
+        lines.append("# TYPE " + self.name + " counter")
+        for label_values, value in self.values.items():
+            lines.append(self.name + format_labels(self.labels, label_values) + " " + format_value(value))
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per bucket counts (last one is +Inf), sum, count]
+        self.series = {}
+
+    def observe(self, value, label_values=()):
+        series = self.series.get(label_values)
+        if series is None:
+            if len(self.series) >= MAX_SERIES:
+                label_values = ("other",) * len(self.labels)
+                series = self.series.get(label_values)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.series[label_values] = series
+
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self, lines):
+        lines.append("# HELP " + self.name + " " + self.help)
+        lines.append("# TYPE " + self.name + " histogram")
+        for label_values, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for index, bound in enumerate(self.buckets + (math.inf,)):
+                cumulative += counts[index]
+                labels = format_labels(self.labels + ("le",), label_values + (format_value(bound),))
+                lines.append(self.name + "_bucket" + labels + " " + str(cumulative))
+
+            labels = format_labels(self.labels, label_values)
+            lines.append(self.name + "_sum" + labels + " " + format_value(total))
+            lines.append(self.name + "_count" + labels + " " + str(count))
+
+class Gauge:
+    # Read when scraped. function returns a number, or a dict of label
+    # values to numbers for labelled gauges.
+    def __init__(self, name, help, function, labels=()):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labels = labels
+
+    def render(self, lines):
+        lines.append("# HELP " + self.name + " " + self.help)
+        lines.append("# TYPE " + self.name + " gauge")
+        value = self.function()
+        if isinstance(value, dict):
+            for label_values, label_value in value.items():
+                lines.append(self.name + format_labels(self.labels, label_values) + " " + format_value(label_value))
+        else:
+            lines.append(self.name + " " + format_value(value))
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, function, labels=()):
+        return self.register(Gauge(name, help, function, labels))
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.metrics:
+            metric.render(lines)
+        return "\n".join(lines) + "\n"
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ""
+
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(name + "=\"" + value + "\"")
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) + ".0"
+    return str(value)
@@ -0,0 +1,65 @@
+# Runs the server as one state owner plus several front-end workers.
+#
+#   python multiworker.py --workers 4 --host 0.0.0.0 --port 8000
+#
+# The state owner is the normal server (server.py). It owns the world and
+# runs all game logic, and serves /metrics and /stats on --admin-port.
+# The workers (worker.py) accept the websocket connections on --port,
+# decode incoming messages and write outgoing ones, and talk to the owner
+# over a Unix socket.
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Minecat with several front-end workers")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--admin-port", type=int, default=8001, help="port of the state owner, for /metrics and /stats")
+    parser.add_argument("--socket", default="./gamedata/ipc.sock", help="Unix socket between the workers and the state owner")
+    parser.add_argument("--log-level", default="info")
+    config = parser.parse_args()
+
+    socket_directory = os.path.dirname(config.socket)
+    if socket_directory:
+        os.makedirs(socket_directory, exist_ok=True)
+    if os.path.exists(config.socket):
+        os.unlink(config.socket)
+
+    environment = dict(os.environ, MINECAT_IPC_SOCKET=config.socket)
+    uvicorn = [sys.executable, "-m", "uvicorn", "--log-level", config.log_level]
+
+    owner = subprocess.Popen(uvicorn + ["server:app", "--host", "127.0.0.1", "--port", str(config.admin_port)], env=environment)
+
+    # Workers retry for a while too, but loading a big world can take longer
+    deadline = time.monotonic() + 60
+    while owner.poll() is None and not os.path.exists(config.socket) and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    # Stop the same way on SIGTERM as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    workers = subprocess.Popen(uvicorn + ["worker:app", "--host", config.host, "--port", str(config.port), "--workers", str(config.workers)], env=environment)
+
+    try:
+        while owner.poll() is None and workers.poll() is None:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Workers first so the owner sees every player leave before it saves
+        for process in (workers, owner):
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+class PlacedItemStore:
+    # Placed items indexed by their (x, y) position and, for chests, by
+    # chest_id. A position holds at most one item.
+
+    def __init__(self):
+        self.items = {}
+        self.chests = {}
+
+    @classmethod
+    def from_list(cls, items):
+        store = cls()
+        for item in items:
+            store.add(item)
+        return store
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items.values())
+
+    def add(self, item):
+        self.remove(item["x"], item["y"])
+
+        self.items[(item["x"], item["y"])] = item
+        if "chest_id" in item:
+            self.chests[item["chest_id"]] = item
+
+    def remove(self, x, y):
+        item = self.items.pop((x, y), None)
+        if item is not None and "chest_id" in item:
+            self.chests.pop(item["chest_id"], None)
+        return item
+
+    def get(self, x, y):
+        return self.items.get((x, y))
+
+    def get_chest(self, chest_id):
+        return self.chests.get(chest_id)
+
+    def add_chest_item(self, chest_id, block_id, count):
+        chest = self.chests.get(chest_id)
+        if chest is None:
+            return False
+
+        chest_inventory = chest.setdefault("chest_inventory", {})
+        block_id = str(block_id)
+        chest_inventory[block_id] = chest_inventory.get(block_id, 0) + count
+        return True
+
+    def to_list(self):
+        return list(self.items.values())
@@ -0,0 +1,67 @@
+class Inventory:
+    # Block counts of a player, keyed by the block id as a string like in
+    # players.json
+
+    __slots__ = ("counts",)
+
+    def __init__(self, counts=None):
+        self.counts = counts if counts is not None else {}
+
+    def add(self, block_id, count):
+        block_id = str(block_id)
+        self.counts[block_id] = self.counts.get(block_id, 0) + count
+
+    def to_dict(self):
+        return self.counts
+
+class PlayerState:
+    # Saved state of one player. Slots instead of a dict per player, the
+    # position stays a dict because it is sent to clients as is.
+
+    __slots__ = ("position", "inventory", "has_flashlight", "holding_item", "current_drill_level", "money")
+
+    def __init__(self, position, inventory=None, has_flashlight=False, holding_item="", current_drill_level=0, money=0):
+        self.position = position
+        self.inventory = inventory if inventory is not None else Inventory()
+        self.has_flashlight = has_flashlight
+        self.holding_item = holding_item
+        self.current_drill_level = current_drill_level
+        self.money = money
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            dict(data["position"]),
+            Inventory(dict(data["inventory"]) if "inventory" in data else {}),
+            data["has_flashlight"] if "has_flashlight" in data else False,
+            data["holding_item"] if "holding_item" in data else "",
+            data["current_drill_level"] if "current_drill_level" in data else 0,
+            data["money"] if "money" in data else 0
+        )
+
+    def update(self, data):
+        # Applies a playerdata update, keys that aren't player data are ignored
+        for key in ("has_flashlight", "holding_item", "current_drill_level", "money"):
+            if key in data:
+                setattr(self, key, data[key])
+
+    def player_data(self):
+        return {
+            "has_flashlight": self.has_flashlight,
+            "holding_item": self.holding_item,
+            "current_drill_level": self.current_drill_level,
+            "money": self.money
+        }
+
+    def to_dict(self):
+        # Shares the position and inventory, serialize it before they change
+        data = self.player_data()
+        data["position"] = self.position
+        data["inventory"] = self.inventory.to_dict()
+        return data
+
+def players_from_dict(players):
+    return {os_uid: PlayerState.from_dict(data) for os_uid, data in players.items()}
+
+def players_to_dict(players):
+    return {os_uid: player.to_dict() for os_uid, player in players.items()}
@@ -0,0 +1,95 @@
+import json
+import struct
+
+# orjson is a lot faster at encoding, but optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PROTOCOLS = ("json", "binary")
+
+# Fixed layout frames for the "binary" protocol, little endian. The first
+# byte is the opcode, followed by the client handle given out in
+# responseconnect/connected. JSON frames always start with "{", so both
+# kinds can share a connection.
+OP_PLAYERPOSITION = 1
+OP_PLAYERHANDROTATION = 2
+OP_SETTILE = 3
+
+PLAYERPOSITION_FRAME = struct.Struct("<BHff") # opcode, handle, x, y
+PLAYERHANDROTATION_FRAME = struct.Struct("<BHf") # opcode, handle, rotation
+SETTILE_FRAME = struct.Struct("<BHiii") # opcode, handle, x, y, id
+
+# Integers orjson can encode, clients send nothing bigger
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 64 - 1
+
+def encode_message(message):
+    # Serializes a message once so the same bytes can be sent to every recipient
+    if orjson is not None:
+        try:
+            return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # orjson.JSONEncodeError, e.g. an integer beyond 64 bits
+            pass
+    return json.dumps(message, separators=(",", ":")).encode("utf-8")
+
+def parse_integer(value):
+    number = int(value)
+    if number < MIN_INTEGER or number > MAX_INTEGER:
+        raise ValueError("Integer out of range: " + value[:32])
+    return number
+
+def parse_constant(value):
+    raise ValueError("Not a JSON number: " + value)
+
+def loads(text):
+    # json.loads that rejects what orjson would refuse to encode again
+    return json.loads(text, parse_int=parse_integer, parse_constant=parse_constant)
+
+def encode_binary_message(message, client_handles):
+    # Returns None for messages without a binary layout, those are sent as JSON
+    message_type = message.get("type")
+    handle = client_handles.get(message.get("client_id"))
+    if handle is None:
+        return None
+
+    try:
+        if message_type == "playerposition":
+            return PLAYERPOSITION_FRAME.pack(OP_PLAYERPOSITION, handle, message["data"]["x"], message["data"]["y"])
+        if message_type == "playerhandrotation":
+            return PLAYERHANDROTATION_FRAME.pack(OP_PLAYERHANDROTATION, handle, message["data"])
+        if message_type == "settile":
+            return SETTILE_FRAME.pack(OP_SETTILE, handle, message["data"]["x"], message["data"]["y"], message["data"]["id"])
+    except (struct.error, TypeError, KeyError):
+        return None
+    return None
+
+def decode_message(frame):
+    # Turns a websocket.receive() message into the JSON form of the message.
+    # Binary frames don't carry a client_id, the caller fills it in.
+    if "decoded" in frame:
+        # Already decoded by a front-end worker
+        return frame["decoded"]
+
+    payload = frame.get("bytes")
+    if payload is None:
+        return loads(frame["text"])
+
+    if len(payload) > 0 and payload[0] == OP_PLAYERPOSITION:
+        _, _, x, y = PLAYERPOSITION_FRAME.unpack(payload)
+        return {"event": "game", "type": "playerposition", "data": {"x": x, "y": y}}
+    if len(payload) > 0 and payload[0] == OP_PLAYERHANDROTATION:
+        _, _, rotation = PLAYERHANDROTATION_FRAME.unpack(payload)
+        return {"event": "game", "type": "playerhandrotation", "data": rotation}
+    if len(payload) > 0 and payload[0] == OP_SETTILE:
+        _, _, x, y, tile_id = SETTILE_FRAME.unpack(payload)
+        return {"event": "game", "type": "settile", "data": {"x": x, "y": y, "id": tile_id}}
+
+    return decode_json(payload)
+
+def decode_json(payload):
+    if orjson is not None:
+        return orjson.loads(payload)
+    return loads(payload)
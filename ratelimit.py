@@ -0,0 +1,53 @@
+class TokenBucket:
+    # Allows rate messages per second on average and bursts of up to burst
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class RateLimiter:
+    # Token buckets per message type for one connection. limits maps a
+    # message type to [rate, burst], types without their own entry share the
+    # "default" bucket. A connection that gets more than max_rejections
+    # messages rejected within window seconds counts as abusive.
+
+    def __init__(self, limits, max_rejections, window, now):
+        self.limits = limits
+        self.max_rejections = max_rejections
+        self.window = window
+        self.buckets = {}
+        self.rejections = 0
+        self.window_start = now
+
+    def admit(self, message_type, now):
+        if not message_type in self.limits:
+            message_type = "default"
+
+        bucket = self.buckets.get(message_type)
+        if bucket is None:
+            rate, burst = self.limits[message_type]
+            bucket = TokenBucket(rate, burst, now)
+            self.buckets[message_type] = bucket
+
+        if bucket.take(now):
+            return True
+
+        if now - self.window_start > self.window:
+            self.window_start = now
+            self.rejections = 0
+        self.rejections += 1
+        return False
+
+    def is_abusive(self):
+        return self.max_rejections > 0 and self.rejections > self.max_rejections
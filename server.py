@@ -1,17 +1,37 @@
 import os
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 
 import random
 import string
 import logging
+import math
 import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
 from pathlib import Path
 import json
 
+from tilestore import MAX_TILE_ID, MIN_TILE_ID, TileStore
+from spatialhash import SpatialHash
+from journal import Journal, replay
+from placeditems import PlacedItemStore
+from droppeditems import DroppedItemStore, stack_data, unit_data
+from changelog import ChangeLog
+from snapshot import read_snapshot, write_snapshot
+from ratelimit import RateLimiter
+from protocol import PROTOCOLS, decode_message, encode_binary_message, encode_message
+from metrics import MetricsRegistry
+from players import PlayerState, players_from_dict, players_to_dict
+from ipc import serve_workers
+
 SERVER_GAME_VERSION = "v1.9"
 
 MAP_SEED = 42069
 MAP_SIZE = {"x": 200, "y": 300} # *32 (tilesize)
+TILE_SIZE = 32
 MAP_GENERATOR_SETTINGS = {
 	"start_height": 12,
 	"map_octaves": 7,
@@ -30,12 +50,102 @@ MAP_POI = {
 
 PLAYER_SPAWNPOINT = {"x": 3200, "y": 300}
 
+SERVER_SETTINGS = {
+    "send_queue_size": 256, # Outbound messages buffered per client
+    "send_queue_overflow": "disconnect", # "disconnect" or "drop_oldest"
+    "send_queue_overflow_grace": 5.0, # Seconds a client may stay over send_queue_size (at most twice that) before it is disconnected, only movement is dropped meanwhile
+    "send_queue_coalesce_movement": True, # Replace queued position/rotation updates with newer ones
+    "interest_management": True, # Only send movement to players within view_radius
+    "view_radius": 48, # In tiles
+    "interest_filter_world_events": False, # Also limit settile/dropitem to players within view_radius
+    "tick_rate": 20, # Server ticks per second
+    "batch_movement": True, # Send movement once per tick instead of on every update
+    "synctime_interval": 5.0, # Seconds between synctime messages
+    "persistence": "journal", # "journal" logs every change, "snapshot" only saves on shutdown
+    "journal_flush_interval": 0.2, # Seconds between journal writes (one fsync each)
+    "journal_compact_interval": 300.0, # Seconds between folding the journal into the saved world
+    "snapshot_format": "binary", # "binary" saves to world.bin, "json" to map.json and players.json
+    "binary_protocol": True, # Allow clients to negotiate binary frames for movement and settile
+    "dropped_item_despawn_time": 300.0, # Seconds until a dropped item disappears, 0 keeps them forever
+    "dropped_item_max_stack": 64, # Identical items dropped on one tile merge into stacks of up to this many
+    "dropped_item_region_size": 16, # In tiles
+    "dropped_item_region_cap": 256, # Stacks per region, the oldest one disappears to make room for a new one
+    "change_log_size": 20000, # World changes kept in memory so reconnecting clients only get what changed
+    "rate_limits": { # [messages per second, burst] per message type and client
+        "playerposition": [100, 200],
+        "playerhandrotation": [100, 200],
+        "settile": [30, 60],
+        "dropitem": [20, 40],
+        "requestmaptiles": [0.5, 3],
+        "requestmapchunks": [0.5, 3],
+        "requestmapdroppeditems": [0.5, 3],
+        "requestmapplaceditems": [1, 5],
+        "requestchanges": [1, 5],
+        "default": [50, 100]
+    },
+    "rate_limit_max_rejections": 200, # Clients with more rejected messages within rate_limit_window are disconnected, 0 never disconnects
+    "rate_limit_window": 10.0, # Seconds
+    "coalesce_inbound_movement": True, # Only handle the newest of the queued position/rotation updates of a client
+    "inbound_queue_size": 256, # Received messages buffered per client before reading pauses
+    "expensive_request_concurrency": 4 # Map downloads handled at the same time across all clients
+}
+
+# Requests that send large parts of the world, they share EXPENSIVE_REQUESTS
+EXPENSIVE_MESSAGE_TYPES = ("requestmaptiles", "requestmapchunks", "requestmapdroppeditems", "requestchanges")
+EXPENSIVE_REQUESTS = None
+# Whether the connection handler running in this task holds a permit of it
+HOLDING_EXPENSIVE_REQUEST = contextvars.ContextVar("holding_expensive_request", default=False)
+
+TICK_STATS = {
+    "ticks": 0,
+    "overruns": 0,
+    "last_duration_ms": 0.0,
+    "average_duration_ms": 0.0,
+    "max_duration_ms": 0.0,
+    "max_lateness_ms": 0.0
+}
+
+# Served on /metrics in the Prometheus text format
+METRICS = MetricsRegistry()
+METRIC_MESSAGES_IN = METRICS.counter("minecat_messages_received_total", "Messages received from clients", ("event", "type"))
+METRIC_MESSAGES_OUT = METRICS.counter("minecat_messages_sent_total", "Messages queued for clients, once per recipient", ("event", "type"))
+METRIC_HANDLER_SECONDS = METRICS.histogram("minecat_handler_seconds", "Time spent handling a received message", ("event", "type"))
+METRIC_BROADCAST_SECONDS = METRICS.histogram("minecat_broadcast_seconds", "Time spent fanning a message out to its recipients", ("kind",))
+METRIC_TICK_SECONDS = METRICS.histogram("minecat_tick_seconds", "Duration of a server tick")
+METRIC_LOOP_LAG_SECONDS = METRICS.histogram("minecat_event_loop_lag_seconds", "How late the server tick started, sampled every tick")
+METRIC_MESSAGES_REJECTED = METRICS.counter("minecat_messages_rejected_total", "Messages dropped by the inbound rate limits", ("type",))
+METRIC_MESSAGES_COALESCED = METRICS.counter("minecat_messages_coalesced_total", "Inbound movement updates replaced by a newer one before being handled", ("type",))
+METRIC_TILES_REJECTED = METRICS.counter("minecat_settile_rejected_total", "settile requests dropped as invalid", ("reason",))
+METRIC_RATE_LIMIT_DISCONNECTS = METRICS.counter("minecat_rate_limit_disconnects_total", "Clients disconnected for exceeding the rate limits")
+
+# Messages which only matter in their latest version, per client
+SUPERSEDABLE_MESSAGE_TYPES = ("playerposition", "playerhandrotation")
+
 # Saved to FS
-MAP_TILES = []
-MAP_DROPPED_ITEMS = {}
-MAP_PLACED_ITEMS = []
+MAP_TILES = TileStore(MAP_SIZE["x"], MAP_SIZE["y"])
+MAP_DROPPED_ITEMS = DroppedItemStore()
+MAP_PLACED_ITEMS = PlacedItemStore()
 MAP_CURRENT_TIME = 0
-PLAYER_DATA = {}
+PLAYER_DATA = {} # os_uid -> PlayerState
+
+# Every world change gets the next revision. Starting from the clock keeps
+# revisions increasing across restarts (up to 2^20 changes per second), so a
+# revision from an earlier run is never mistaken for one of this run.
+CHANGE_LOG = ChangeLog(int(time.time()) << 20, SERVER_SETTINGS["change_log_size"])
+
+JOURNAL_PATH = "./gamedata/journal.log"
+JOURNAL = None
+
+MAP_DATA_PATH = "./gamedata/map.json"
+PLAYER_DATA_PATH = "./gamedata/players.json"
+WORLD_SNAPSHOT_PATH = "./gamedata/world.bin"
+
+# Set by multiworker.py, connections forwarded by front-end workers arrive on this Unix socket
+IPC_SOCKET_PATH = os.environ.get("MINECAT_IPC_SOCKET")
+
+# Guards the saved world, which journal compaction writes from a worker thread
+SNAPSHOT_LOCK = threading.Lock()
+SNAPSHOT_SEQ = {}
 
 app = FastAPI()
 logger = logging.getLogger("uvicorn.info")
@@ -49,128 +159,814 @@ async def startup_event():
 
     load_fs_data()
 
+    global EXPENSIVE_REQUESTS
+    EXPENSIVE_REQUESTS = asyncio.Semaphore(SERVER_SETTINGS["expensive_request_concurrency"])
+
     loop = asyncio.get_running_loop()
     # loop = asyncio.get_event_loop()
     loop.create_task(core_loop())
 
+    if JOURNAL is not None:
+        loop.create_task(JOURNAL.run())
+        loop.create_task(journal_compaction_loop())
+
+    if IPC_SOCKET_PATH:
+        await serve_workers(IPC_SOCKET_PATH, websocket_endpoint)
+        logger.info("Accepting front-end workers on " + IPC_SOCKET_PATH)
+
 @app.on_event("shutdown")
 def shutdown_event():
+    if JOURNAL is not None:
+        JOURNAL.flush_now()
+
     save_fs_data()
-    logger.info("Server stopped!")
 
-async def core_loop():
-    global MAP_CURRENT_TIME
+    if JOURNAL is not None:
+        JOURNAL.truncate()
+        JOURNAL.close()
 
+    logger.info("Server stopped!")
+
+def record_mutation(entry, coalesce_key=None):
+    if JOURNAL is not None:
+        JOURNAL.append(entry, coalesce_key)
+
+def valid_position(position):
+    # Positions are stored, saved and put in the spatial hash, so x and y
+    # have to be finite numbers
+    if not isinstance(position, dict):
+        return False
+
+    for key in ("x", "y"):
+        value = position.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            return False
+    return True
+
+def settile_values(data):
+    # x, y and id of a settile as ints, or None when one of them isn't an
+    # integer or doesn't fit. Coordinates are int32 like in the binary
+    # protocol, ids have to fit the cells of the TileStore.
+    if not isinstance(data, dict):
+        return None
+
+    values = []
+    for key, low, high in (("x", -2147483648, 2147483647), ("y", -2147483648, 2147483647), ("id", MIN_TILE_ID, MAX_TILE_ID)):
+        value = data.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        if isinstance(value, float) and not value.is_integer():
+            return None
+        value = int(value)
+        if value < low or value > high:
+            return None
+        values.append(value)
+    return values
+
+def record_change(*changes):
+    # changes are (kind, key) pairs: ("tile", (x, y)), ("placed", (x, y)),
+    # ("dropped", stack uid) and ("dropped_unit", item uid)
+    return CHANGE_LOG.record(changes)
+
+def dropped_item_changes(stack_uid, unit_uids):
+    return [("dropped", stack_uid)] + [("dropped_unit", unit_uid) for unit_uid in unit_uids]
+
+async def send_changes(websocket, client_id, revision):
+    # Brings a client from revision up to date with what changed since, or
+    # tells it to do a full sync when the change log doesn't go back that far
+    if isinstance(revision, float) and revision.is_integer():
+        revision = int(revision)
+
+    changes = CHANGE_LOG.changes_since(revision) if isinstance(revision, int) else None
+    if changes is None:
+        await manager.send(websocket, {"event": "game", "type": "responsechanges", "data": {"revision": CHANGE_LOG.revision, "full": True}})
+        return
+
+    client = manager.clients.get(client_id)
+    placed_item_deltas = client is not None and client.placed_item_deltas
+    item_stacks = client is not None and client.item_stacks
+
+    response_map_tiles = []
+    for x, y in changes.get("tile", []):
+        tile_id = MAP_TILES.get(x, y)
+        if tile_id is not None:
+            response_map_tiles.append({"x": x, "y": y, "id": tile_id})
+
+        if len(response_map_tiles) >= 100:
+            await manager.send(websocket, {"event": "game", "type": "responsemaptiles", "data": response_map_tiles})
+            response_map_tiles = []
+
+    if len(response_map_tiles) > 0:
+        await manager.send(websocket, {"event": "game", "type": "responsemaptiles", "data": response_map_tiles})
+
+    if "placed" in changes:
+        if placed_item_deltas:
+            for x, y in changes["placed"]:
+                item = MAP_PLACED_ITEMS.get(x, y)
+                if item is not None:
+                    await manager.send(websocket, {"event": "game", "type": "addmapplaceditem", "client_id": 0, "data": item})
+                else:
+                    await manager.send(websocket, {"event": "game", "type": "removemapplaceditem", "client_id": 0, "data": {"x": x, "y": y}})
+        else:
+            await manager.send(websocket, {"event": "game", "type": "responsemapplaceditems", "client_id": 0, "data": MAP_PLACED_ITEMS.to_list()})
+
+    if item_stacks:
+        # updatedroppeditem carries the whole stack, clients create it if they don't know it
+        for stack_uid in changes.get("dropped", []):
+            stack = MAP_DROPPED_ITEMS.get(stack_uid)
+            if stack is not None:
+                await manager.send(websocket, {"event": "game", "type": "updatedroppeditem", "client_id": 0, "data": stack_data(stack_uid, stack)})
+            else:
+                await manager.send(websocket, {"event": "game", "type": "removedroppeditem", "client_id": 0, "data": {"uid": stack_uid}})
+    else:
+        # The client may already have seen the item, remove it first so it isn't shown twice
+        for unit_uid in changes.get("dropped_unit", []):
+            await manager.send(websocket, {"event": "game", "type": "removedroppeditem", "client_id": 0, "data": {"uid": unit_uid}})
+            stack = MAP_DROPPED_ITEMS.get(MAP_DROPPED_ITEMS.units.get(unit_uid))
+            if stack is not None:
+                await manager.send(websocket, {"event": "game", "type": "dropitem", "client_id": 0, "data": unit_data(unit_uid, stack)})
+
+    await manager.send(websocket, {"event": "game", "type": "responsechanges", "data": {"revision": CHANGE_LOG.revision, "full": False}})
+
+async def journal_compaction_loop():
     while True:
-        sleep_time = 5.0
-        # target_fps = 60.0
+        await asyncio.sleep(SERVER_SETTINGS["journal_compact_interval"])
 
-        await asyncio.sleep(sleep_time)
+        try:
+            release_world_snapshot()
+            await JOURNAL.compact(compact_fs_data)
+        except Exception as exception:
+            logger.error("Journal compaction failed: " + repr(exception))
 
-        # delta = 1.0 / target_fps
-        MAP_CURRENT_TIME += sleep_time / 2
+async def core_loop():
+    global MAP_CURRENT_TIME
+
+    next_tick = time.monotonic()
+    last_synctime = next_tick
 
-        await manager.broadcast(message={"event": "server", "type": "synctime", "clientid": 0, "data": {"time": MAP_CURRENT_TIME}})
+    while True:
+        tick_interval = 1.0 / SERVER_SETTINGS["tick_rate"]
+        next_tick += tick_interval
+
+        await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+
+        tick_start = time.monotonic()
+
+        # One failing tick must not stop the ticks after it
+        try:
+            sync_time = None
+            if tick_start - last_synctime >= SERVER_SETTINGS["synctime_interval"]:
+                last_synctime = tick_start
+                MAP_CURRENT_TIME += SERVER_SETTINGS["synctime_interval"] / 2
+                sync_time = MAP_CURRENT_TIME
+                record_mutation({"op": "maptime", "time": MAP_CURRENT_TIME}, "maptime")
+
+            manager.send_snapshots(TICK_STATS["ticks"], sync_time)
+
+            for stack_uid, stack in MAP_DROPPED_ITEMS.expire(time.time()):
+                record_mutation({"op": "removedroppeditem", "uid": stack_uid})
+                record_change(*dropped_item_changes(stack_uid, stack["units"]))
+                await manager.broadcast_dropped_item_removal(0, stack_uid, stack)
+        except Exception:
+            logger.exception("Tick " + str(TICK_STATS["ticks"]) + " failed")
+
+        tick_end = time.monotonic()
+        update_tick_stats(tick_end - tick_start, tick_start - next_tick, tick_interval)
+        METRIC_TICK_SECONDS.observe(tick_end - tick_start)
+        METRIC_LOOP_LAG_SECONDS.observe(max(0.0, tick_start - next_tick))
+
+        # Don't try to catch up on ticks that were missed entirely
+        if tick_end > next_tick + tick_interval:
+            next_tick = tick_end
+
+def update_tick_stats(duration, lateness, tick_interval):
+    duration_ms = duration * 1000
+
+    TICK_STATS["ticks"] += 1
+    TICK_STATS["last_duration_ms"] = duration_ms
+    TICK_STATS["average_duration_ms"] += (duration_ms - TICK_STATS["average_duration_ms"]) * 0.05
+    TICK_STATS["max_duration_ms"] = max(TICK_STATS["max_duration_ms"], duration_ms)
+    TICK_STATS["max_lateness_ms"] = max(TICK_STATS["max_lateness_ms"], lateness * 1000)
+
+    if duration + max(0.0, lateness) > tick_interval:
+        TICK_STATS["overruns"] += 1
+
+class InboundQueue:
+    # Reads the frames of one connection in its own task. Messages over the
+    # rate limits are dropped here, and queued movement is replaced by newer
+    # updates, so a flooding client can't keep the handler loop busy.
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.messages = deque()
+        self.movement = {}
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.limiter = RateLimiter(SERVER_SETTINGS["rate_limits"], SERVER_SETTINGS["rate_limit_max_rejections"], SERVER_SETTINGS["rate_limit_window"], time.monotonic())
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        try:
+            while True:
+                while len(self.messages) >= SERVER_SETTINGS["inbound_queue_size"]:
+                    self.space.clear()
+                    await self.space.wait()
+
+                frame = await self.websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    self.push(("disconnect", frame.get("code", 1000)))
+                    return
+
+                data = decode_message(frame)
+                message_type = data.get("type", "")
+                if not isinstance(message_type, str):
+                    message_type = ""
+
+                entry = self.movement.get(message_type)
+                if entry is not None:
+                    entry[1] = data
+                    METRIC_MESSAGES_COALESCED.inc((message_type,))
+                    continue
+
+                if not self.limiter.admit(message_type, time.monotonic()):
+                    METRIC_MESSAGES_REJECTED.inc((message_type,))
+                    if self.limiter.is_abusive():
+                        logger.warning("Disconnecting " + str(manager.get_client_id(self.websocket)) + ", too many messages over the rate limits")
+                        METRIC_RATE_LIMIT_DISCONNECTS.inc()
+                        self.push(("disconnect", 1008))
+                        await self.websocket.close(code=1008)
+                        return
+                    continue
+
+                entry = ["message", data]
+                if SERVER_SETTINGS["coalesce_inbound_movement"] and message_type in SUPERSEDABLE_MESSAGE_TYPES:
+                    self.movement[message_type] = entry
+                self.push(entry)
+        except Exception as exception:
+            # Handled like before, the connection's handler raises it
+            self.push(("error", exception))
+
+    def push(self, entry):
+        self.messages.append(entry)
+        self.ready.set()
+
+    async def get(self):
+        # Next message, raises WebSocketDisconnect once the client is gone
+        while len(self.messages) == 0:
+            self.ready.clear()
+            await self.ready.wait()
+
+        entry = self.messages.popleft()
+        self.space.set()
+
+        if entry[0] == "disconnect":
+            raise WebSocketDisconnect(entry[1])
+        if entry[0] == "error":
+            raise entry[1]
+
+        message_type = entry[1].get("type")
+        if self.movement.get(message_type) is entry:
+            self.movement.pop(message_type)
+        return entry[1]
+
+    def close(self):
+        self.task.cancel()
+
+class SendQueue:
+    # Bounded outbound queue with its own writer task, so a slow socket
+    # only delays the messages of its own client
+
+    def __init__(self, websocket: WebSocket, client_id):
+        self.websocket = websocket
+        self.client_id = client_id
+        self.messages = deque()
+        self.superseded = {}
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.overflow_since = None
+        self.closed = False
+        self.stats = {"sent": 0, "dropped": 0, "coalesced": 0, "max_depth": 0}
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def put(self, message, payload, mode="binary"):
+        # payload is the already encoded message, shared between recipients
+        if self.closed:
+            return False
+
+        METRIC_MESSAGES_OUT.inc((message.get("event", ""), message.get("type", "")))
+
+        key = None
+        if SERVER_SETTINGS["send_queue_coalesce_movement"] and message.get("type") in SUPERSEDABLE_MESSAGE_TYPES:
+            key = (message["type"], message.get("client_id"))
+            if key in self.superseded:
+                self.superseded[key][1] = payload
+                self.stats["coalesced"] += 1
+                return True
+
+        if len(self.messages) >= SERVER_SETTINGS["send_queue_size"]:
+            if SERVER_SETTINGS["send_queue_overflow"] == "drop_oldest":
+                self.drop_oldest()
+            else:
+                # World state is never dropped, the client would be out of
+                # sync for good. The queue may grow to twice its size during
+                # the grace period.
+                if self.overflow_since is None:
+                    self.overflow_since = time.monotonic()
+                if len(self.messages) >= 2 * SERVER_SETTINGS["send_queue_size"] or time.monotonic() - self.overflow_since > SERVER_SETTINGS["send_queue_overflow_grace"]:
+                    logger.warning("Disconnecting " + str(self.client_id) + ", send queue stayed over its limit (" + str(len(self.messages)) + " messages)")
+                    self.close()
+                    asyncio.get_running_loop().create_task(self.websocket.close(code=1008))
+                    return False
+
+                # Movement is superseded by the next update
+                if message.get("type") in SUPERSEDABLE_MESSAGE_TYPES:
+                    self.stats["dropped"] += 1
+                    return True
+
+        entry = [key, payload, mode]
+        self.messages.append(entry)
+        if key is not None:
+            self.superseded[key] = entry
+
+        self.stats["max_depth"] = max(self.stats["max_depth"], len(self.messages))
+        self.ready.set()
+        return True
+
+    async def put_wait(self, message, payload, mode="binary"):
+        # Used for replies to this client, waits for room instead of overflowing
+        while not self.closed and len(self.messages) >= SERVER_SETTINGS["send_queue_size"]:
+            # A client that stops reading must not hold up the map
+            # downloads of everyone else, the permit is given back meanwhile
+            holding = HOLDING_EXPENSIVE_REQUEST.get()
+            if holding:
+                EXPENSIVE_REQUESTS.release()
+                HOLDING_EXPENSIVE_REQUEST.set(False)
+
+            self.space.clear()
+            await self.space.wait()
+
+            if holding:
+                await EXPENSIVE_REQUESTS.acquire()
+                HOLDING_EXPENSIVE_REQUEST.set(True)
+
+        return self.put(message, payload, mode)
+
+    def pop(self):
+        entry = self.messages.popleft()
+        if entry[0] is not None and self.superseded.get(entry[0]) is entry:
+            self.superseded.pop(entry[0])
+
+        if len(self.messages) < SERVER_SETTINGS["send_queue_size"]:
+            self.overflow_since = None
+            self.space.set()
+        return entry
+
+    def drop_oldest(self):
+        self.pop()
+        self.stats["dropped"] += 1
+
+    async def run(self):
+        while not self.closed:
+            if len(self.messages) == 0:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            _, payload, mode = self.pop()
+            try:
+                if mode == "text":
+                    await self.websocket.send_text(payload.decode("utf-8"))
+                else:
+                    await self.websocket.send_bytes(payload)
+                self.stats["sent"] += 1
+            except Exception as exception:
+                logger.info("Stopped sending to " + str(self.client_id) + ": " + repr(exception))
+                self.close()
+
+    def close(self):
+        self.closed = True
+        self.messages.clear()
+        self.superseded.clear()
+        self.ready.set()
+        self.space.set()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["depth"] = len(self.messages)
+        stats["overflowing"] = self.overflow_since is not None
+        return stats
+
+
+class Session:
+    # One connected client, found by client_id in ConnectionManager.clients
+    # and by websocket in ConnectionManager.sessions
+
+    __slots__ = ("client_id", "os_uid", "username", "websocket", "send_queue", "player", "position", "snapshots", "placed_item_deltas", "item_stacks", "protocol")
+
+    def __init__(self, client_id, os_uid, username, websocket, send_queue, player, snapshots=False, placed_item_deltas=False, item_stacks=False, protocol="json"):
+        self.client_id = client_id
+        self.os_uid = os_uid
+        self.username = username
+        self.websocket = websocket
+        self.send_queue = send_queue
+        self.player = player
+        self.position = player.position
+        self.snapshots = snapshots
+        self.placed_item_deltas = placed_item_deltas
+        self.item_stacks = item_stacks
+        self.protocol = protocol
 
 class ConnectionManager:
     def __init__(self):
         self.clients = {}
-
-    def connect(self, client_id, os_uid, username, websocket: WebSocket):
+        # WebSocket isn't hashable, sessions are keyed by its id()
+        self.sessions = {}
+        self.send_queues = {}
+        self.player_positions = SpatialHash(16 * TILE_SIZE)
+        self.visible_players = {}
+        self.pending_movement = {}
+        self.client_handles = {}
+        self.free_client_handles = []
+        self.next_client_handle = 1
+
+    def connect(self, client_id, os_uid, username, websocket: WebSocket, snapshots=False, placed_item_deltas=False, item_stacks=False, protocol="json"):
         global PLAYER_DATA
 
-        self.clients[client_id] = {
-            "os_uid": os_uid,
-            "username": username,
-            "position": {"x": 0, "y": 0},
-            "websocket": websocket
+        # Small integer id used instead of client_id in binary frames
+        if not client_id in self.client_handles:
+            if len(self.free_client_handles) > 0:
+                self.client_handles[client_id] = self.free_client_handles.pop()
+            else:
+                self.client_handles[client_id] = self.next_client_handle
+                self.next_client_handle += 1
 
-        }
+        # WebSocket isn't hashable, queues are keyed by its id()
+        if id(websocket) in self.send_queues:
+            self.send_queues[id(websocket)].close()
+        send_queue = SendQueue(websocket, client_id)
+        self.send_queues[id(websocket)] = send_queue
 
         if not os_uid in PLAYER_DATA:
-            PLAYER_DATA[os_uid] = {
-                "position": {
-                    "x": PLAYER_SPAWNPOINT["x"],
-                    "y": PLAYER_SPAWNPOINT["y"]
-                },
-                "inventory": {},
-                "has_flashlight": False,
-                "holding_item": "",
-                "current_drill_level": 0,
-                "money": 0
-            }
+            PLAYER_DATA[os_uid] = PlayerState({"x": PLAYER_SPAWNPOINT["x"], "y": PLAYER_SPAWNPOINT["y"]})
+            record_mutation({"op": "playerjoin", "os_uid": os_uid, "data": PLAYER_DATA[os_uid].to_dict()})
+
+        # Players saved with a position that can't be used start at the spawn point
+        if not valid_position(PLAYER_DATA[os_uid].position):
+            PLAYER_DATA[os_uid].position = {"x": PLAYER_SPAWNPOINT["x"], "y": PLAYER_SPAWNPOINT["y"]}
+            record_mutation({"op": "playerposition", "os_uid": os_uid, "position": PLAYER_DATA[os_uid].position}, ("playerposition", os_uid))
+
+        # A websocket that connects again under another client_id replaces its old session
+        previous = self.sessions.get(id(websocket))
+        if previous is not None and previous.client_id != client_id:
+            self.remove_session(previous)
+
+        session = Session(client_id, os_uid, username, websocket, send_queue, PLAYER_DATA[os_uid], snapshots, placed_item_deltas, item_stacks, protocol)
+        self.clients[client_id] = session
+        self.sessions[id(websocket)] = session
+
+        # Enter events are only sent once the player starts moving
+        spawn_position = session.position
+        self.player_positions.update(client_id, spawn_position["x"], spawn_position["y"])
+        self.visible_players[client_id] = set()
 
     def disconnect(self, websocket: WebSocket):
-        for client in self.clients.keys():
-            if self.clients[client]["websocket"] == websocket:
-                self.clients.pop(client)
-                break
-    
+        if id(websocket) in self.send_queues:
+            self.send_queues.pop(id(websocket)).close()
+
+        # Returns the session that was removed, None when the websocket had
+        # none or its client_id already belongs to a newer session
+        session = self.sessions.pop(id(websocket), None)
+        if session is not None and self.remove_session(session):
+            return session
+        return None
+
+    def remove_session(self, session):
+        # The client_id may already belong to a newer session, returns
+        # whether this one was still current
+        if self.clients.get(session.client_id) is not session:
+            return False
+
+        client = session.client_id
+        self.clients.pop(client)
+        self.pending_movement.pop(client, None)
+        self.free_client_handles.append(self.client_handles.pop(client))
+        self.player_positions.remove(client)
+        for other_client in self.visible_players.pop(client, ()):
+            if other_client in self.visible_players:
+                self.visible_players[other_client].discard(client)
+        return True
+
+    def get_session(self, websocket: WebSocket):
+        return self.sessions.get(id(websocket))
+
     def get_username(self, websocket: WebSocket):
-        for client in self.clients.keys():
-            if self.clients[client]["websocket"] == websocket:
-                return self.clients[client]["username"]
+        session = self.sessions.get(id(websocket))
+        return session.username if session is not None else None
 
     def get_client_id(self, websocket: WebSocket):
-        for client in self.clients.keys():
-            if self.clients[client]["websocket"] == websocket:
-                return client
+        session = self.sessions.get(id(websocket))
+        return session.client_id if session is not None else None
 
     async def broadcast(self, exclude_client_id = None, message = {}):
+        # Only enqueues, the per client writer tasks do the sending
+        started = time.perf_counter()
+        payloads = {}
         for client in self.clients.keys():
-            try:
-                if client != exclude_client_id:
-                    await self.clients[client]["websocket"].send_json(message, "binary")
-            except:
-                pass
+            if client != exclude_client_id:
+                self.send_to(client, message, payloads)
+        METRIC_BROADCAST_SECONDS.observe(time.perf_counter() - started, ("all",))
+
+    async def broadcast_nearby(self, client_id, message = {}):
+        # Sends to the players that can see client_id, and client_id itself
+        if not SERVER_SETTINGS["interest_management"] or not client_id in self.visible_players:
+            await self.broadcast(message=message)
+            return
+
+        started = time.perf_counter()
+        payloads = {}
+        self.send_to(client_id, message, payloads)
+        for client in self.visible_players[client_id]:
+            self.send_to(client, message, payloads)
+        METRIC_BROADCAST_SECONDS.observe(time.perf_counter() - started, ("nearby",))
+
+    async def broadcast_world_event(self, tile_x, tile_y, message = {}):
+        if not SERVER_SETTINGS["interest_management"] or not SERVER_SETTINGS["interest_filter_world_events"]:
+            await self.broadcast(message=message)
+            return
+
+        started = time.perf_counter()
+        payloads = {}
+        for client in self.get_world_event_recipients(tile_x, tile_y):
+            self.send_to(client, message, payloads)
+        METRIC_BROADCAST_SECONDS.observe(time.perf_counter() - started, ("world_event",))
+
+    def get_world_event_recipients(self, tile_x, tile_y):
+        if not SERVER_SETTINGS["interest_management"] or not SERVER_SETTINGS["interest_filter_world_events"]:
+            return list(self.clients.keys())
+
+        radius = SERVER_SETTINGS["view_radius"] * TILE_SIZE
+        return self.player_positions.query(tile_x * TILE_SIZE, tile_y * TILE_SIZE, radius)
+
+    async def broadcast_dropped_item(self, client_id, stack_uid, stack, unit_uid, merged):
+        # Clients with item_stacks get the stack or its new count, others
+        # get every dropped item on its own like before
+        started = time.perf_counter()
+        stack_message = {"event": "game", "type": "updatedroppeditem" if merged else "dropitem", "client_id": client_id, "data": stack_data(stack_uid, stack)}
+        unit_message = {"event": "game", "type": "dropitem", "client_id": client_id, "data": unit_data(unit_uid, stack)}
+        stack_payloads = {}
+        unit_payloads = {}
+
+        for client in self.get_world_event_recipients(stack["x"], stack["y"]):
+            if self.clients[client].item_stacks:
+                self.send_to(client, stack_message, stack_payloads)
+            else:
+                self.send_to(client, unit_message, unit_payloads)
+        METRIC_BROADCAST_SECONDS.observe(time.perf_counter() - started, ("dropped_items",))
+
+    async def broadcast_dropped_item_removal(self, client_id, stack_uid, stack, unit_uid=None):
+        # unit_uid is set when a single item was picked up, otherwise the
+        # whole stack is gone
+        started = time.perf_counter()
+        if unit_uid is not None and len(stack["units"]) > 0:
+            stack_message = {"event": "game", "type": "updatedroppeditem", "client_id": client_id, "data": stack_data(stack_uid, stack)}
+        else:
+            stack_message = {"event": "game", "type": "removedroppeditem", "client_id": client_id, "data": {"uid": stack_uid}}
+
+        removed_units = [unit_uid] if unit_uid is not None else stack["units"]
+        unit_messages = [({"event": "game", "type": "removedroppeditem", "client_id": client_id, "data": unit_data(uid, stack)}, {}) for uid in removed_units]
+        stack_payloads = {}
+
+        for client in self.clients.keys():
+            if self.clients[client].item_stacks:
+                self.send_to(client, stack_message, stack_payloads)
+            else:
+                for message, payloads in unit_messages:
+                    self.send_to(client, message, payloads)
+        METRIC_BROADCAST_SECONDS.observe(time.perf_counter() - started, ("dropped_items",))
+
+    async def broadcast_movement(self, client_id, movement_type, value):
+        # movement_type is "playerposition" or "playerhandrotation"
+        if not SERVER_SETTINGS["batch_movement"]:
+            await self.broadcast_nearby(client_id, message={"event": "game", "type": movement_type, "client_id": client_id, "data": value})
+            return
+
+        key = "position" if movement_type == "playerposition" else "rotation"
+        self.pending_movement.setdefault(client_id, {})[key] = value
+
+    def send_snapshots(self, tick, sync_time=None):
+        # Called once per tick. Clients that asked for snapshots get all
+        # movement of the tick in one message, others get one coalesced
+        # playerposition/playerhandrotation per moved player.
+        started = time.perf_counter()
+        pending_movement = self.pending_movement
+        self.pending_movement = {}
+
+        recipient_movement = {}
+        for mover, movement in pending_movement.items():
+            if SERVER_SETTINGS["interest_management"] and mover in self.visible_players:
+                recipients = list(self.visible_players[mover])
+                recipients.append(mover)
+            else:
+                recipients = self.clients.keys()
+
+            for recipient in recipients:
+                recipient_movement.setdefault(recipient, {})[mover] = movement
+
+        # Per mover messages for clients without snapshots are encoded once
+        encoded_movement = {}
+        sync_time_message = {"event": "server", "type": "synctime", "clientid": 0, "data": {"time": sync_time, "revision": CHANGE_LOG.revision}}
+        sync_time_payloads = {}
+
+        for client in self.clients.keys():
+            movement = recipient_movement.get(client)
+
+            if self.clients[client].snapshots:
+                if movement is None and sync_time is None:
+                    continue
+
+                snapshot = {"tick": tick, "players": movement or {}}
+                if sync_time is not None:
+                    snapshot["time"] = sync_time
+                    snapshot["revision"] = CHANGE_LOG.revision
+                self.send_to(client, {"event": "game", "type": "snapshot", "data": snapshot})
+                continue
+
+            if movement is not None:
+                for mover, changes in movement.items():
+                    if not mover in encoded_movement:
+                        messages = []
+                        if "position" in changes:
+                            messages.append({"event": "game", "type": "playerposition", "client_id": mover, "data": changes["position"]})
+                        if "rotation" in changes:
+                            messages.append({"event": "game", "type": "playerhandrotation", "client_id": mover, "data": changes["rotation"]})
+                        encoded_movement[mover] = [(message, {}) for message in messages]
+
+                    for message, payloads in encoded_movement[mover]:
+                        self.send_to(client, message, payloads)
+
+            if sync_time is not None:
+                self.send_to(client, sync_time_message, sync_time_payloads)
+
+        if len(pending_movement) > 0 or sync_time is not None:
+            METRIC_BROADCAST_SECONDS.observe(time.perf_counter() - started, ("snapshot",))
+
+    async def broadcast_placed_item_change(self, client_id, message = {}):
+        # Clients that didn't ask for placed_item_deltas still get the full list
+        started = time.perf_counter()
+        payloads = {}
+        full_list_message = None
+        full_list_payloads = {}
+
+        for client in self.clients.keys():
+            if self.clients[client].placed_item_deltas:
+                self.send_to(client, message, payloads)
+            else:
+                if full_list_message is None:
+                    full_list_message = {"event": "game", "type": "responsemapplaceditems", "client_id": client_id, "data": MAP_PLACED_ITEMS.to_list()}
+                self.send_to(client, full_list_message, full_list_payloads)
+        METRIC_BROADCAST_SECONDS.observe(time.perf_counter() - started, ("placed_items",))
+
+    def send_to(self, client_id, message, payloads=None):
+        # payloads caches the message encoded per protocol, pass the same
+        # dict for every recipient of a message to only encode it once
+        session = self.clients.get(client_id)
+        if session is not None:
+            session.send_queue.put(message, self.encode(message, session.protocol, payloads))
+
+    def encode(self, message, protocol, payloads=None):
+        if payloads is not None and protocol in payloads:
+            return payloads[protocol]
+
+        payload = None
+        if protocol == "binary":
+            payload = encode_binary_message(message, self.client_handles)
+        if payload is None:
+            payload = encode_message(message)
+
+        if payloads is not None:
+            payloads[protocol] = payload
+        return payload
+
+    async def send(self, websocket: WebSocket, message, mode="binary"):
+        # Replies go through the client's queue to keep them ordered with broadcasts
+        send_queue = self.send_queues.get(id(websocket))
+        if send_queue is None:
+            if mode == "text":
+                await websocket.send_text(encode_message(message).decode("utf-8"))
+            else:
+                await websocket.send_bytes(encode_message(message))
+        else:
+            session = self.sessions.get(id(websocket))
+            await send_queue.put_wait(message, self.encode(message, session.protocol if session is not None else "json"), mode)
+
+    def get_send_queue_stats(self):
+        stats = {}
+        for client, session in self.clients.items():
+            stats[client] = session.send_queue.get_stats()
+            stats[client]["username"] = session.username
+        return stats
     
     def get_clients(self):
         formatted_clients = {}
-        for client in self.clients.keys():
-            try:
-                formatted_clients[client] = {
-                    "username": self.clients[client]["username"],
-                    "position": self.clients[client]["position"]
-                }
-            except:
-                pass
+        for client, session in self.clients.items():
+            formatted_clients[client] = {
+                "username": session.username,
+                "position": session.position,
+                "client_handle": self.client_handles[client]
+            }
             
         return formatted_clients
     
     def get_client_os_uid(self, client_id):
-        return self.clients[client_id]["os_uid"]
+        return self.clients[client_id].os_uid
+
+    def get_player(self, client_id):
+        return self.clients[client_id].player
     
     def update_player_position(self, client_id, position):
-        if client_id in self.clients.keys():
-            self.clients[client_id]["position"] = position
-        PLAYER_DATA[self.get_client_os_uid(client_id)]["position"] = position
+        session = self.clients[client_id]
+        session.position = position
+        session.player.position = position
+        record_mutation({"op": "playerposition", "os_uid": session.os_uid, "position": position}, ("playerposition", session.os_uid))
+
+        if SERVER_SETTINGS["interest_management"] and client_id in self.visible_players:
+            self.update_visible_players(client_id, position)
+
+    def update_visible_players(self, client_id, position):
+        # Sends enter/leave events to both sides when two players cross each other's view range
+        self.player_positions.update(client_id, position["x"], position["y"])
+
+        in_range = set(self.player_positions.query(position["x"], position["y"], SERVER_SETTINGS["view_radius"] * TILE_SIZE))
+        in_range.discard(client_id)
+        visible = self.visible_players[client_id]
+
+        for other_client in in_range - visible:
+            visible.add(other_client)
+            self.visible_players[other_client].add(client_id)
+            self.send_to(client_id, {"event": "game", "type": "playerenteredview", "client_id": other_client, "client_handle": self.client_handles[other_client], "username": self.clients[other_client].username, "data": self.clients[other_client].position})
+            self.send_to(other_client, {"event": "game", "type": "playerenteredview", "client_id": client_id, "client_handle": self.client_handles[client_id], "username": self.clients[client_id].username, "data": position})
+
+        for other_client in visible - in_range:
+            visible.discard(other_client)
+            self.visible_players[other_client].discard(client_id)
+            self.send_to(client_id, {"event": "game", "type": "playerleftview", "client_id": other_client})
+            self.send_to(other_client, {"event": "game", "type": "playerleftview", "client_id": client_id})
     
     def update_player_inventory(self, client_id, block_id, count):
-        if not str(block_id) in PLAYER_DATA[self.get_client_os_uid(client_id)]["inventory"]:
-            PLAYER_DATA[self.get_client_os_uid(client_id)]["inventory"][str(block_id)] = count
-        else:
-            PLAYER_DATA[self.get_client_os_uid(client_id)]["inventory"][str(block_id)] += count
+        session = self.clients[client_id]
+        session.player.inventory.add(block_id, count)
+        record_mutation({"op": "playerinventory", "os_uid": session.os_uid, "block_id": block_id, "count": count})
     
     def update_player_data(self, client_id, has_flashlight, holding_item, current_drill_level, money):
-        PLAYER_DATA[self.get_client_os_uid(client_id)]["has_flashlight"] = has_flashlight
-        PLAYER_DATA[self.get_client_os_uid(client_id)]["holding_item"] = holding_item
-        PLAYER_DATA[self.get_client_os_uid(client_id)]["current_drill_level"] = current_drill_level
-        PLAYER_DATA[self.get_client_os_uid(client_id)]["money"] = money
+        session = self.clients[client_id]
+        player = session.player
+        player.has_flashlight = has_flashlight
+        player.holding_item = holding_item
+        player.current_drill_level = current_drill_level
+        player.money = money
+
+        record_mutation({"op": "playerdata", "os_uid": session.os_uid, "data": player.player_data()})
 
 
 manager = ConnectionManager()
 
+METRICS.gauge("minecat_connected_clients", "Connected clients", lambda: len(manager.clients))
+METRICS.gauge("minecat_send_queue_messages", "Messages waiting in all send queues", lambda: sum(len(send_queue.messages) for send_queue in manager.send_queues.values()))
+METRICS.gauge("minecat_world_objects", "Size of the world state", lambda: {
+    ("tiles",): len(MAP_TILES),
+    ("dropped_items",): len(MAP_DROPPED_ITEMS),
+    ("placed_items",): len(MAP_PLACED_ITEMS)
+}, ("kind",))
+METRICS.gauge("minecat_journal_pending_entries", "Journal entries waiting to be written", lambda: len(JOURNAL.pending) if JOURNAL is not None else 0)
+
+@app.get("/stats/sendqueues")
+async def send_queue_stats():
+    return manager.get_send_queue_stats()
+
+@app.get("/stats/tick")
+async def tick_stats():
+    return dict(TICK_STATS, tick_rate=SERVER_SETTINGS["tick_rate"])
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
 @app.websocket("/")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
 
+    # Set once the handshake completes, binary frames don't carry a client_id
+    connection_client_id = None
+
+    inbound = InboundQueue(websocket)
+
     try:
         while True:
-            data = {}
-            try:
-                data = await websocket.receive_json("binary")
-            except KeyError:
-                data = await websocket.receive_json("text")
+            data = await inbound.get()
+
+            handler_start = time.perf_counter()
+            if not "client_id" in data and connection_client_id is not None:
+                data["client_id"] = connection_client_id
             
             event = data["event"] if "event" in data else ""
             type = data["type"] if "type" in data else ""
@@ -178,12 +974,20 @@ async def websocket_endpoint(websocket: WebSocket):
             username = data["username"] if "username" in data else ""
             # event_data = data["data"] if "data" in data else ""
 
+            metric_labels = (str(event), str(type))
+            METRIC_MESSAGES_IN.inc(metric_labels)
+
+            # Limits how many clients download the map at once
+            if type in EXPENSIVE_MESSAGE_TYPES:
+                await EXPENSIVE_REQUESTS.acquire()
+                HOLDING_EXPENSIVE_REQUEST.set(True)
+
             if event == "handshake":
 
                 if type == "requestid":
 
                         client_id = id_generator(size=6)
-                        await websocket.send_json({"event": "handshake", "type": "responseid", "data": client_id}, "binary")
+                        await manager.send(websocket, {"event": "handshake", "type": "responseid", "data": client_id})
                 
                 if type == "requestconnect":
                     status = "OK"
@@ -192,15 +996,36 @@ async def websocket_endpoint(websocket: WebSocket):
                         status = "UNSUPPORTED_GAME_VERSION"
                     else:
                         os_uid = data["os_uid"] if "os_uid" in data else client_id
-                        manager.connect(client_id=client_id, os_uid=os_uid, username=username, websocket=websocket)
+                        snapshots = data["snapshots"] if "snapshots" in data else False
+                        placed_item_deltas = data["placed_item_deltas"] if "placed_item_deltas" in data else False
+                        item_stacks = data["item_stacks"] if "item_stacks" in data else False
+
+                        protocol = data["protocol"] if "protocol" in data else "json"
+                        if not protocol in PROTOCOLS or not SERVER_SETTINGS["binary_protocol"]:
+                            protocol = "json"
+
+                        manager.connect(client_id=client_id, os_uid=os_uid, username=username, websocket=websocket, snapshots=snapshots, placed_item_deltas=placed_item_deltas, item_stacks=item_stacks, protocol=protocol)
+                        connection_client_id = client_id
                         logger.info(username + " (" + client_id + ") has joined the server!")
 
-                        await manager.broadcast(message={"event": "game", "type": "connected", "client_id": client_id, "username": username})
+                        await manager.broadcast(message={"event": "game", "type": "connected", "client_id": client_id, "client_handle": manager.client_handles[client_id], "username": username})
+
+                    response = {"event": "handshake", "type": "responseconnect", "data": status}
+                    if status == "OK":
+                        response["protocol"] = manager.clients[client_id].protocol
+                        response["client_handle"] = manager.client_handles[client_id]
+                        response["revision"] = CHANGE_LOG.revision
+                    await manager.send(websocket, response)
+                    await manager.send(websocket, {"event": "server", "type": "synctime", "clientid": 0, "data": {"time": MAP_CURRENT_TIME, "revision": CHANGE_LOG.revision}}, "text")
 
-                    await websocket.send_json({"event": "handshake", "type": "responseconnect", "data": status}, "binary")
-                    await websocket.send_json({"event": "server", "type": "synctime", "clientid": 0, "data": {"time": MAP_CURRENT_TIME}})
+                    # A reconnecting client passes the last revision it saw
+                    if status == "OK" and "revision" in data:
+                        await send_changes(websocket, client_id, data["revision"])
 
             if event == "game":
+
+                    if type == "requestchanges":
+                        await send_changes(websocket, client_id, data["data"]["revision"])
                     
                     if type == "requestmapdata":
 
@@ -208,72 +1033,103 @@ async def websocket_endpoint(websocket: WebSocket):
                             "map_seed": MAP_SEED,
                             "map_size": MAP_SIZE,
                             "map_generator_settings": MAP_GENERATOR_SETTINGS,
-                            "map_poi": MAP_POI
+                            "map_poi": MAP_POI,
+                            "map_chunk_size": MAP_TILES.chunk_size
                         }
-                        await websocket.send_json({"event": "game", "type": "responsemapdata", "data": response}, "binary")
+                        await manager.send(websocket, {"event": "game", "type": "responsemapdata", "data": response})
 
                     if type == "requestmaptiles":
 
                         response_map_tiles = []
 
-                        for tile_data in MAP_TILES:
-                            response_map_tiles.append(tile_data)
+                        for tile_x, tile_y, tile_id in MAP_TILES:
+                            response_map_tiles.append({"x": tile_x, "y": tile_y, "id": tile_id})
 
                             if len(response_map_tiles) >= 100:
-                                await websocket.send_json({"event": "game", "type": "responsemaptiles", "data": response_map_tiles}, "binary")
+                                await manager.send(websocket, {"event": "game", "type": "responsemaptiles", "data": response_map_tiles})
                                 response_map_tiles = []
 
                         if len(response_map_tiles) > 0:
-                            await websocket.send_json({"event": "game", "type": "responsemaptiles", "data": response_map_tiles}, "binary")
+                            await manager.send(websocket, {"event": "game", "type": "responsemaptiles", "data": response_map_tiles})
                     
-                    if type == "requestmapdroppeditems":
+                    if type == "requestmapchunks":
+                        # Chunked alternative to requestmaptiles, nearest chunks are sent first
+                        request_data = data["data"] if "data" in data else {}
 
-                        response_map_dropped_items = []
+                        if "x" in request_data and "y" in request_data:
+                            center = (request_data["x"], request_data["y"])
+                        else:
+                            position = manager.get_player(client_id).position
+                            center = (position["x"] // TILE_SIZE, position["y"] // TILE_SIZE)
+
+                        radius = request_data["radius"] if "radius" in request_data else None
+                        chunk_keys = MAP_TILES.chunks_by_distance(center[0], center[1], radius)
+
+                        for chunk_key in chunk_keys:
+                            await manager.send(websocket, {"event": "game", "type": "responsemapchunk", "data": MAP_TILES.encode_chunk(chunk_key)})
 
-                        for item_uid in MAP_DROPPED_ITEMS:
-                            item_data = MAP_DROPPED_ITEMS[item_uid]
-                            item_data["uid"] = item_uid
+                        # Tiles outside of MAP_SIZE don't belong to a chunk
+                        if radius is None and len(MAP_TILES.outside) > 0:
+                            response_map_tiles = [{"x": x, "y": y, "id": tile_id} for (x, y), tile_id in MAP_TILES.outside.items()]
+                            await manager.send(websocket, {"event": "game", "type": "responsemaptiles", "data": response_map_tiles})
 
-                            response_map_dropped_items.append(item_data)
+                        await manager.send(websocket, {"event": "game", "type": "responsemapchunksdone", "data": {"chunks": len(chunk_keys)}})
+
+                    if type == "requestmapdroppeditems":
+                        # Items near the player are sent first, optionally only within radius (in regions)
+                        request_data = data["data"] if "data" in data else {}
+
+                        if "x" in request_data and "y" in request_data:
+                            center = (request_data["x"], request_data["y"])
+                        elif client_id in manager.clients:
+                            position = manager.get_player(client_id).position
+                            center = (position["x"] // TILE_SIZE, position["y"] // TILE_SIZE)
+                        else:
+                            center = (PLAYER_SPAWNPOINT["x"] // TILE_SIZE, PLAYER_SPAWNPOINT["y"] // TILE_SIZE)
+
+                        radius = request_data["radius"] if "radius" in request_data else None
+                        item_stacks = client_id in manager.clients and manager.clients[client_id].item_stacks
+                        response_map_dropped_items = []
+
+                        for stack_uid, stack in MAP_DROPPED_ITEMS.nearest(center[0], center[1], radius):
+                            if item_stacks:
+                                response_map_dropped_items.append(stack_data(stack_uid, stack))
+                            else:
+                                response_map_dropped_items.extend(unit_data(unit_uid, stack) for unit_uid in stack["units"])
 
                             if len(response_map_dropped_items) >= 100:
-                                await websocket.send_json({"event": "game", "type": "responsemapdroppeditems", "data": response_map_dropped_items}, "binary")
+                                await manager.send(websocket, {"event": "game", "type": "responsemapdroppeditems", "data": response_map_dropped_items})
                                 response_map_dropped_items = []
 
                         if len(response_map_dropped_items) > 0:
-                            await websocket.send_json({"event": "game", "type": "responsemapdroppeditems", "data": response_map_dropped_items}, "binary")
+                            await manager.send(websocket, {"event": "game", "type": "responsemapdroppeditems", "data": response_map_dropped_items})
                     
                     if type == "requestclients":
                         response = manager.get_clients()
 
-                        await websocket.send_json({"event": "game", "type": "responseclients", "data": response}, "binary")
+                        await manager.send(websocket, {"event": "game", "type": "responseclients", "data": response})
                     
                     if type == "requestplayerspawnpoint":
                         # spawnpoint = PLAYER_SPAWNPOINT.copy()
                         # spawnpoint["x"] += random.randrange(-50, 300)
-                        spawnpoint = PLAYER_DATA[manager.get_client_os_uid(client_id)]["position"]
-                        await websocket.send_json({"event": "game", "type": "responseplayerspawnpoint", "data": spawnpoint}, "binary")
+                        spawnpoint = manager.get_player(client_id).position
+                        await manager.send(websocket, {"event": "game", "type": "responseplayerspawnpoint", "data": spawnpoint})
                     
                     if type == "requestplayerinventory":
-                        inventory = PLAYER_DATA[manager.get_client_os_uid(client_id)]["inventory"]
-                        await websocket.send_json({"event": "game", "type": "responseplayerinventory", "data": inventory}, "binary")
+                        inventory = manager.get_player(client_id).inventory.to_dict()
+                        await manager.send(websocket, {"event": "game", "type": "responseplayerinventory", "data": inventory})
                     
                     if type == "requestplayerdata":
-                        await websocket.send_json({"event": "game", "type": "responseplayerdata", "data": {
-                            "has_flashlight": PLAYER_DATA[manager.get_client_os_uid(client_id)]["has_flashlight"],
-		                    "holding_item": PLAYER_DATA[manager.get_client_os_uid(client_id)]["holding_item"],
-		                    "current_drill_level": PLAYER_DATA[manager.get_client_os_uid(client_id)]["current_drill_level"],
-		                    "money": PLAYER_DATA[manager.get_client_os_uid(client_id)]["money"]
-                        }}, "binary")
-
-                    if type == "playerposition":
+                        await manager.send(websocket, {"event": "game", "type": "responseplayerdata", "data": manager.get_player(client_id).player_data()})
+
+                    if type == "playerposition" and valid_position(data.get("data")):
                         position = data["data"]
                         manager.update_player_position(client_id, position)
-                        await manager.broadcast(message={"event": "game", "type": "playerposition", "client_id": client_id, "data": position})
+                        await manager.broadcast_movement(client_id, "playerposition", position)
                     
                     if type == "playerhandrotation":
                         rotation = data["data"]
-                        await manager.broadcast(message={"event": "game", "type": "playerhandrotation", "client_id": client_id, "data": rotation})
+                        await manager.broadcast_movement(client_id, "playerhandrotation", rotation)
                     
                     if type == "updateplayerdata":
                         has_flashlight = data["data"]["has_flashlight"]
@@ -290,59 +1146,66 @@ async def websocket_endpoint(websocket: WebSocket):
                         }})
                     
                     if type == "settile":
-                        tile_position = {"x": data["data"]["x"], "y": data["data"]["y"]}
-                        tile_id = data["data"]["id"]
+                        # Checked before the store sees it, the broadcast carries the values as stored
+                        values = settile_values(data["data"])
+                        if values is None:
+                            METRIC_TILES_REJECTED.inc(("invalid",))
+                        else:
+                            tile_x, tile_y, tile_id = values
+                            data["data"].update({"x": tile_x, "y": tile_y, "id": tile_id})
 
-                        already_mined = False
-                        save_tile = True
-                        for tile in MAP_TILES:
-                            if tile["x"] == tile_position["x"] and tile["y"] == tile_position["y"]:
-                                if tile["id"] == tile_id:
-                                    already_mined = True
-                                else:
-                                    save_tile = False
-                                    tile["id"] = tile_id
-                        
-                        if save_tile and not already_mined:
-                            MAP_TILES.append({"x": tile_position["x"], "y": tile_position["y"], "id": tile_id})
+                            if MAP_TILES.set(tile_x, tile_y, tile_id):
+                                record_mutation({"op": "settile", "x": tile_x, "y": tile_y, "id": tile_id})
+                                record_change(("tile", (tile_x, tile_y)))
 
-                        await manager.broadcast(message={"event": "game", "type": "settile", "client_id": client_id, "data": data["data"]})
+                            await manager.broadcast_world_event(tile_x, tile_y, message={"event": "game", "type": "settile", "client_id": client_id, "data": data["data"]})
 
                     if type == "dropitem":
                         tile_position = {"x": data["data"]["x"], "y": data["data"]["y"]}
                         tile_id = data["data"]["id"]
                         tile_drop_id = id_generator(size=6)
+                        while tile_drop_id in MAP_DROPPED_ITEMS:
+                            tile_drop_id = id_generator(size=6)
 
-                        tile_drop = {
-                            "x": tile_position["x"],
-                            "y": tile_position["y"],
-                            "id": tile_id,
-                            "uid": tile_drop_id
-                        }
+                        stack_uid, merged, evicted = MAP_DROPPED_ITEMS.drop(tile_drop_id, tile_position["x"], tile_position["y"], tile_id, time.time())
 
-                        MAP_DROPPED_ITEMS[tile_drop_id] = {
-                            "x": tile_position["x"],
-                            "y": tile_position["y"],
-                            "id": tile_id
-                        }
+                        # Stacks removed to stay under the region cap
+                        for evicted_uid, evicted_stack in evicted:
+                            record_mutation({"op": "removedroppeditem", "uid": evicted_uid})
+                            record_change(*dropped_item_changes(evicted_uid, evicted_stack["units"]))
+                            await manager.broadcast_dropped_item_removal(0, evicted_uid, evicted_stack)
+
+                        stack = MAP_DROPPED_ITEMS.get(stack_uid)
+                        record_mutation({"op": "dropitem", "uid": tile_drop_id, "stack": stack_uid, "x": tile_position["x"], "y": tile_position["y"], "id": tile_id, "despawn_at": stack["despawn_at"]})
+                        record_change(*dropped_item_changes(stack_uid, [tile_drop_id]))
 
-                        await manager.broadcast(message={"event": "game", "type": "dropitem", "client_id": client_id, "data": tile_drop})
+                        await manager.broadcast_dropped_item(client_id, stack_uid, stack, tile_drop_id, merged)
                     
                     if type == "removedroppeditem":
-
-                        if data["data"]["uid"] in MAP_DROPPED_ITEMS:
-                            MAP_DROPPED_ITEMS.pop(data["data"]["uid"])
+                        uid = data["data"]["uid"]
+
+                        # Clients with item_stacks pick up a whole stack, others a single item
+                        if client_id in manager.clients and manager.clients[client_id].item_stacks:
+                            stack = MAP_DROPPED_ITEMS.remove_stack(uid)
+                            if stack is not None:
+                                record_mutation({"op": "removedroppeditem", "uid": uid})
+                                record_change(*dropped_item_changes(uid, stack["units"]))
+                                await manager.broadcast_dropped_item_removal(client_id, uid, stack)
+                        else:
+                            removed = MAP_DROPPED_ITEMS.remove_unit(uid)
+                            if removed is not None:
+                                record_mutation({"op": "removedroppedunit", "uid": uid})
+                                record_change(*dropped_item_changes(removed[0], [uid]))
+                                await manager.broadcast_dropped_item_removal(client_id, removed[0], removed[1], uid)
                         
                         # manager.update_player_inventory(client_id, data["data"]["block_id"], 1)
-
-                        await manager.broadcast(message={"event": "game", "type": "removedroppeditem", "client_id": client_id, "data": data["data"]})
                     
                     if type == "addinventoryitem":
 
                         manager.update_player_inventory(client_id, data["data"]["block_id"], data["data"]["count"])
                     
                     if type == "requestmapplaceditems":
-                        await manager.broadcast(message={"event": "game", "type": "responsemapplaceditems", "client_id": client_id, "data": MAP_PLACED_ITEMS})
+                        await manager.send(websocket, {"event": "game", "type": "responsemapplaceditems", "client_id": client_id, "data": MAP_PLACED_ITEMS.to_list()})
                     
                     if type == "addmapplaceditem":
 
@@ -358,44 +1221,55 @@ async def websocket_endpoint(websocket: WebSocket):
                             chest_id = id_generator(size=6)
                             item_data["chest_id"] = chest_id
 
-                        MAP_PLACED_ITEMS.append(item_data)
+                        MAP_PLACED_ITEMS.add(item_data)
+                        record_mutation({"op": "addplaceditem", "item": item_data})
+                        record_change(("placed", (item_data["x"], item_data["y"])))
 
-                        await manager.broadcast(message={"event": "game", "type": "responsemapplaceditems", "client_id": client_id, "data": MAP_PLACED_ITEMS})
+                        await manager.broadcast_placed_item_change(client_id, message={"event": "game", "type": "addmapplaceditem", "client_id": client_id, "data": item_data})
 
                     if type == "removemapplaceditem":
 
-                        for placed_item in MAP_PLACED_ITEMS:
-                            if placed_item["x"] == data["data"]["x"] and placed_item["y"] == data["data"]["y"]:
-                                MAP_PLACED_ITEMS.remove(placed_item)
-                                break
-                        
-                        await manager.broadcast(message={"event": "game", "type": "responsemapplaceditems", "client_id": client_id, "data": MAP_PLACED_ITEMS})
+                        if MAP_PLACED_ITEMS.remove(data["data"]["x"], data["data"]["y"]) is not None:
+                            record_mutation({"op": "removeplaceditem", "x": data["data"]["x"], "y": data["data"]["y"]})
+                            record_change(("placed", (data["data"]["x"], data["data"]["y"])))
+
+                            await manager.broadcast_placed_item_change(client_id, message={"event": "game", "type": "removemapplaceditem", "client_id": client_id, "data": {"x": data["data"]["x"], "y": data["data"]["y"]}})
                     
                     if type == "addchestitem":
-                        for item in MAP_PLACED_ITEMS:
-                            if item["type"] == "CHEST":
-                                if item["chest_id"] == data["data"]["chest_id"]:
-                                    if not "chest_inventory" in item:
-                                        item["chest_inventory"] = {}
-
-                                    if not str(data["data"]["block_id"]) in item["chest_inventory"]:
-                                        item["chest_inventory"][str(data["data"]["block_id"])] = data["data"]["count"]
-                                    else:
-                                        item["chest_inventory"][str(data["data"]["block_id"])] += data["data"]["count"]
-                                    
-
                         CHEST_DATA = {
                             "chest_id": data["data"]["chest_id"],
                             "block_id": data["data"]["block_id"],
                             "count": data["data"]["count"]
                         }
 
+                        if MAP_PLACED_ITEMS.add_chest_item(CHEST_DATA["chest_id"], CHEST_DATA["block_id"], CHEST_DATA["count"]):
+                            record_mutation(dict(CHEST_DATA, op="addchestitem"))
+                            chest = MAP_PLACED_ITEMS.get_chest(CHEST_DATA["chest_id"])
+                            record_change(("placed", (chest["x"], chest["y"])))
+
                         await manager.broadcast(message={"event": "game", "type": "addchestitem", "client_id": client_id, "data": CHEST_DATA})
 
+            if HOLDING_EXPENSIVE_REQUEST.get():
+                EXPENSIVE_REQUESTS.release()
+                HOLDING_EXPENSIVE_REQUEST.set(False)
+
+            METRIC_HANDLER_SECONDS.observe(time.perf_counter() - handler_start, metric_labels)
+
     except WebSocketDisconnect:
-        logger.info(manager.get_username(websocket) + " (" + manager.get_client_id(websocket) + ") has left the server!")
-        await manager.broadcast(message={"event": "game", "type": "disconnected", "client_id": manager.get_client_id(websocket), "username": manager.get_username(websocket)})
-        manager.disconnect(websocket)
+        pass
+    finally:
+        inbound.close()
+        if HOLDING_EXPENSIVE_REQUEST.get():
+            EXPENSIVE_REQUESTS.release()
+            HOLDING_EXPENSIVE_REQUEST.set(False)
+
+        # Also when a handler raised, so no session is left behind. Clients
+        # that never sent requestconnect have no session, and one replaced
+        # by a newer connection with its client_id hasn't left.
+        session = manager.disconnect(websocket)
+        if session is not None:
+            logger.info(session.username + " (" + session.client_id + ") has left the server!")
+            await manager.broadcast(message={"event": "game", "type": "disconnected", "client_id": session.client_id, "username": session.username})
 
 def load_fs_data():
     global MAP_TILES
@@ -409,6 +1283,8 @@ def load_fs_data():
     global MAP_GENERATOR_SETTINGS
     global MAP_POI
     global PLAYER_SPAWNPOINT
+    global JOURNAL
+    global CHANGE_LOG
 
     Path("./gamedata").mkdir(parents=True, exist_ok=True)
 
@@ -420,6 +1296,7 @@ def load_fs_data():
             MAP_GENERATOR_SETTINGS = data["map_generator_settings"]
             MAP_POI = data["map_poi"]
             PLAYER_SPAWNPOINT = data["player_spawn_point"]
+            SERVER_SETTINGS.update(data.get("server_settings", {}))
     except:
         with open("./server.json", 'w') as outfile:
             data = {
@@ -427,41 +1304,190 @@ def load_fs_data():
                 "map_size": MAP_SIZE,
                 "map_generator_settings": MAP_GENERATOR_SETTINGS,
                 "map_poi": MAP_POI,
-                "player_spawn_point": PLAYER_SPAWNPOINT
+                "player_spawn_point": PLAYER_SPAWNPOINT,
+                "server_settings": SERVER_SETTINGS
             }
             json.dump(data, outfile)
 
-    try:
-        with open("./gamedata/map.json", 'r') as reader:
-            data = json.load(reader)
-            MAP_TILES = data["map_tiles"]
-            MAP_DROPPED_ITEMS = data["map_dropped_items"]
-            MAP_PLACED_ITEMS = data["map_placed_items"]
-            MAP_CURRENT_TIME = data["map_time"]
-    except:
-        save_fs_data(save_map_data=True, save_player_data=False)
-
-    try:
-        with open("./gamedata/players.json", 'r') as reader:
-            data = json.load(reader)
-            PLAYER_DATA = data["player_data"]
-    except:
-        save_fs_data(save_map_data=False, save_player_data=True)
+    CHANGE_LOG = ChangeLog(CHANGE_LOG.revision, SERVER_SETTINGS["change_log_size"])
+
+    MAP_TILES = TileStore(MAP_SIZE["x"], MAP_SIZE["y"])
+    MAP_DROPPED_ITEMS = create_dropped_item_store({})
+    map_seq = 0
+    player_seq = 0
+    binary = SERVER_SETTINGS["snapshot_format"] == "binary"
+
+    if binary and os.path.exists(WORLD_SNAPSHOT_PATH):
+        # Tiles stay in the memory mapped file until they are used
+        data = read_snapshot(WORLD_SNAPSHOT_PATH, MAP_SIZE["x"], MAP_SIZE["y"])
+        MAP_TILES = data["map_tiles"]
+        MAP_DROPPED_ITEMS = create_dropped_item_store(data["map_dropped_items"])
+        MAP_PLACED_ITEMS = PlacedItemStore.from_list(data["map_placed_items"])
+        MAP_CURRENT_TIME = data["map_time"]
+        PLAYER_DATA = data["player_data"]
+        map_seq = data["map_seq"]
+        player_seq = data["player_seq"]
+    else:
+        # A missing file is a new world, one that can't be loaded stops the
+        # server instead of being overwritten or migrated without its data
+        if os.path.exists(MAP_DATA_PATH):
+            try:
+                with open(MAP_DATA_PATH, 'r') as reader:
+                    data = json.load(reader)
+                    MAP_TILES = TileStore.from_list(MAP_SIZE["x"], MAP_SIZE["y"], data["map_tiles"])
+                    MAP_DROPPED_ITEMS = create_dropped_item_store(data["map_dropped_items"])
+                    MAP_PLACED_ITEMS = PlacedItemStore.from_list(data["map_placed_items"])
+                    MAP_CURRENT_TIME = data["map_time"]
+                    map_seq = data.get("journal_seq", 0)
+            except Exception as exception:
+                logger.error("Could not load " + MAP_DATA_PATH + ", not starting: " + repr(exception))
+                raise
+        elif not binary:
+            save_fs_data(save_map_data=True, save_player_data=False)
+
+        if os.path.exists(PLAYER_DATA_PATH):
+            try:
+                with open(PLAYER_DATA_PATH, 'r') as reader:
+                    data = json.load(reader)
+                    PLAYER_DATA = players_from_dict(data["player_data"])
+                    player_seq = data.get("journal_seq", 0)
+            except Exception as exception:
+                logger.error("Could not load " + PLAYER_DATA_PATH + ", not starting: " + repr(exception))
+                raise
+        elif not binary:
+            save_fs_data(save_map_data=False, save_player_data=True)
+
+        if binary:
+            # One-shot migration, the JSON files are kept aside as a backup
+            # once world.bin holds everything they did
+            write_world_snapshot(current_world(), map_seq, player_seq)
+            for path in (MAP_DATA_PATH, PLAYER_DATA_PATH):
+                if os.path.exists(path):
+                    os.replace(path, path + ".migrated")
+                    logger.info("Migrated " + path + " to " + WORLD_SNAPSHOT_PATH)
+
+    if SERVER_SETTINGS["persistence"] == "journal":
+        journal = Journal(JOURNAL_PATH, flush_interval=SERVER_SETTINGS["journal_flush_interval"])
+
+        # Changes made after the last snapshot, including an unfinished compaction
+        world = current_world()
+        journal.seq = replay(world, [journal.compacting_path, journal.path], map_seq, player_seq)
+        MAP_CURRENT_TIME = world["map_time"]
+
+        JOURNAL = journal
+
+def create_dropped_item_store(items):
+    return DroppedItemStore.from_dict(
+        items,
+        region_size=SERVER_SETTINGS["dropped_item_region_size"],
+        region_cap=SERVER_SETTINGS["dropped_item_region_cap"],
+        max_stack=SERVER_SETTINGS["dropped_item_max_stack"],
+        despawn_time=SERVER_SETTINGS["dropped_item_despawn_time"]
+    )
+
+def current_world():
+    return {
+        "map_tiles": MAP_TILES,
+        "map_dropped_items": MAP_DROPPED_ITEMS,
+        "map_placed_items": MAP_PLACED_ITEMS,
+        "map_time": MAP_CURRENT_TIME,
+        "player_data": PLAYER_DATA
+    }
+
+def release_world_snapshot():
+    # Windows can't replace world.bin while the tiles still map it
+    if os.name == "nt":
+        MAP_TILES.detach()
 
 def save_fs_data(save_map_data: bool = True, save_player_data: bool = True):
+    journal_seq = JOURNAL.seq if JOURNAL is not None else 0
+
+    if SERVER_SETTINGS["snapshot_format"] == "binary":
+        # world.bin always holds the map and the players
+        release_world_snapshot()
+        write_world_snapshot(current_world(), journal_seq, journal_seq)
+        return
+
     if save_map_data:
-        with open("./gamedata/map.json", 'w') as outfile:
-            data = {
-                "map_tiles": MAP_TILES,
-                "map_dropped_items": MAP_DROPPED_ITEMS,
-                "map_placed_items": MAP_PLACED_ITEMS,
-                "map_time": MAP_CURRENT_TIME
-            }
-            json.dump(data, outfile)
+        write_fs_data(MAP_DATA_PATH, {
+            "map_tiles": MAP_TILES.to_list(),
+            "map_dropped_items": MAP_DROPPED_ITEMS.to_dict(),
+            "map_placed_items": MAP_PLACED_ITEMS.to_list(),
+            "map_time": MAP_CURRENT_TIME,
+            "journal_seq": journal_seq
+        })
     
     if save_player_data:
-        with open("./gamedata/players.json", 'w') as outfile:
-            data = {
-                "player_data": PLAYER_DATA
-            }
+        write_fs_data(PLAYER_DATA_PATH, {
+            "player_data": players_to_dict(PLAYER_DATA),
+            "journal_seq": journal_seq
+        })
+
+def write_fs_data(path, data):
+    # Goes through a temporary file so a crash never leaves a half written
+    # snapshot, and never replaces a snapshot with an older one
+    with SNAPSHOT_LOCK:
+        if data["journal_seq"] < SNAPSHOT_SEQ.get(path, 0):
+            return
+
+        with open(path + ".tmp", 'w') as outfile:
             json.dump(data, outfile)
+        os.replace(path + ".tmp", path)
+
+        SNAPSHOT_SEQ[path] = data["journal_seq"]
+
+def write_world_snapshot(world, map_seq, player_seq):
+    path = WORLD_SNAPSHOT_PATH
+    with SNAPSHOT_LOCK:
+        if max(map_seq, player_seq) < SNAPSHOT_SEQ.get(path, 0):
+            return
+
+        write_snapshot(path + ".tmp", world, map_seq, player_seq)
+        os.replace(path + ".tmp", path)
+
+        SNAPSHOT_SEQ[path] = max(map_seq, player_seq)
+
+def compact_fs_data(compacting_path):
+    # Runs in a worker thread, folds a moved aside journal into the snapshot
+    # on disk without touching the live world
+    if SERVER_SETTINGS["snapshot_format"] == "binary":
+        data = read_snapshot(WORLD_SNAPSHOT_PATH, MAP_SIZE["x"], MAP_SIZE["y"], lazy=False)
+        world = {
+            "map_tiles": data["map_tiles"],
+            "map_dropped_items": create_dropped_item_store(data["map_dropped_items"]),
+            "map_placed_items": PlacedItemStore.from_list(data["map_placed_items"]),
+            "map_time": data["map_time"],
+            "player_data": data["player_data"]
+        }
+        journal_seq = replay(world, [compacting_path], data["map_seq"], data["player_seq"])
+        write_world_snapshot(world, journal_seq, journal_seq)
+
+        Path(compacting_path).unlink(missing_ok=True)
+        return
+
+    with open(MAP_DATA_PATH, 'r') as reader:
+        map_data = json.load(reader)
+    with open(PLAYER_DATA_PATH, 'r') as reader:
+        player_data = json.load(reader)
+
+    world = {
+        "map_tiles": TileStore.from_list(MAP_SIZE["x"], MAP_SIZE["y"], map_data["map_tiles"]),
+        "map_dropped_items": create_dropped_item_store(map_data["map_dropped_items"]),
+        "map_placed_items": PlacedItemStore.from_list(map_data["map_placed_items"]),
+        "map_time": map_data["map_time"],
+        "player_data": players_from_dict(player_data["player_data"])
+    }
+    journal_seq = replay(world, [compacting_path], map_data.get("journal_seq", 0), player_data.get("journal_seq", 0))
+    write_fs_data(MAP_DATA_PATH, {
+        "map_tiles": world["map_tiles"].to_list(),
+        "map_dropped_items": world["map_dropped_items"].to_dict(),
+        "map_placed_items": world["map_placed_items"].to_list(),
+        "map_time": world["map_time"],
+        "journal_seq": journal_seq
+    })
+    write_fs_data(PLAYER_DATA_PATH, {
+        "player_data": players_to_dict(world["player_data"]),
+        "journal_seq": journal_seq
+    })
+
+    Path(compacting_path).unlink(missing_ok=True)
@@ -0,0 +1,142 @@
+import json
+import mmap
+import struct
+import zlib
+
+from players import players_from_dict, players_to_dict
+from tilestore import TileStore
+
+# Binary world snapshot, all little endian:
+#
+#   HEADER    magic, version, chunk size, map width and height, journal seq
+#             of the map and of the players, map time, number of sections
+#   SECTION   per section: tag, offset, length
+#   "TCHK"    CHUNK_RECORD per modified chunk: chunk x, chunk y, modified cells
+#   "TDAT"    the chunks in TCHK order, chunk size * chunk size int32 cells
+#             each, EMPTY_TILE for cells that hold their generated tile
+#   "TOUT"    TILE_RECORD per modified tile outside of the map, with 64 bit
+#             coordinates as those aren't bounded by the map size
+#   "DROP"    dropped items, zlib compressed JSON
+#   "PLCD"    placed items, zlib compressed JSON
+#   "PLYR"    player data, zlib compressed JSON
+#
+# Every chunk in TDAT has the same size, so chunk n starts at a fixed
+# offset and the tiles can be read straight from a memory mapped file.
+
+MAGIC = b"MCWS"
+VERSION = 2
+
+HEADER = struct.Struct("<4sHHIIIQQdI")
+SECTION = struct.Struct("<4sQQ")
+CHUNK_RECORD = struct.Struct("<iiI")
+TILE_RECORD = struct.Struct("<qqi")
+
+# Version 1 stored TOUT with 32 bit coordinates, otherwise the layout is the same
+TILE_RECORDS = {1: struct.Struct("<iii"), VERSION: TILE_RECORD}
+
+# TDAT starts on a page boundary
+PAGE_SIZE = 4096
+
+def write_snapshot(path, world, map_seq, player_seq):
+    # world holds the same keys as the world passed to journal.replay
+    tiles = world["map_tiles"]
+    chunk_keys = sorted(tiles.chunk_counts.keys())
+
+    chunk_table = bytearray()
+    for key in chunk_keys:
+        chunk_table += CHUNK_RECORD.pack(key[0], key[1], tiles.chunk_counts[key])
+
+    outside = bytearray()
+    for (x, y), tile_id in tiles.outside.items():
+        outside += TILE_RECORD.pack(x, y, tile_id)
+
+    blobs = [
+        (b"TCHK", bytes(chunk_table)),
+        (b"TOUT", bytes(outside)),
+        (b"DROP", compress(world["map_dropped_items"].to_dict())),
+        (b"PLCD", compress(world["map_placed_items"].to_list())),
+        (b"PLYR", compress(players_to_dict(world["player_data"])))
+    ]
+
+    chunk_bytes = 4 * tiles.chunk_size * tiles.chunk_size
+    offset = HEADER.size + SECTION.size * (len(blobs) + 1)
+    sections = []
+    for tag, blob in blobs:
+        sections.append((tag, offset, len(blob)))
+        offset += len(blob)
+    padding = -offset % PAGE_SIZE
+    sections.append((b"TDAT", offset + padding, chunk_bytes * len(chunk_keys)))
+
+    with open(path, "wb") as outfile:
+        outfile.write(HEADER.pack(MAGIC, VERSION, tiles.chunk_size, tiles.width, tiles.height, 0, map_seq, player_seq, world["map_time"], len(sections)))
+        for section in sections:
+            outfile.write(SECTION.pack(*section))
+        for tag, blob in blobs:
+            outfile.write(blob)
+        outfile.write(bytes(padding))
+
+        # Chunks that were never loaded are copied from the old snapshot as is
+        for key in chunk_keys:
+            outfile.write(tiles.chunk_bytes(key))
+
+def read_snapshot(path, width, height, lazy=True):
+    # Returns the world as stored, with the tiles in a TileStore and the
+    # players as PlayerStates. With lazy the file is memory mapped and
+    # chunks are only read once they are used.
+    with open(path, "rb") as reader:
+        if lazy:
+            buffer = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buffer = reader.read()
+
+    magic, version, chunk_size, map_width, map_height, _, map_seq, player_seq, map_time, section_count = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version not in TILE_RECORDS:
+        raise ValueError("Not a version " + str(VERSION) + " world snapshot: " + str(path))
+
+    sections = {}
+    for index in range(section_count):
+        tag, offset, length = SECTION.unpack_from(buffer, HEADER.size + index * SECTION.size)
+        sections[tag] = (offset, length)
+
+    def section(tag):
+        offset, length = sections[tag]
+        return buffer[offset:offset + length]
+
+    world = {
+        "map_dropped_items": decompress(section(b"DROP")),
+        "map_placed_items": decompress(section(b"PLCD")),
+        "map_time": map_time,
+        "player_data": players_from_dict(decompress(section(b"PLYR"))),
+        "map_seq": map_seq,
+        "player_seq": player_seq
+    }
+
+    chunk_bytes = 4 * chunk_size * chunk_size
+    data_offset = sections[b"TDAT"][0]
+    chunk_table = []
+    for index, (chunk_x, chunk_y, count) in enumerate(CHUNK_RECORD.iter_unpack(section(b"TCHK"))):
+        chunk_table.append((chunk_x, chunk_y, count, data_offset + index * chunk_bytes))
+
+    tiles = TileStore.from_mapped(map_width, map_height, chunk_size, buffer, chunk_table)
+    for x, y, tile_id in TILE_RECORDS[version].iter_unpack(section(b"TOUT")):
+        tiles.outside[(x, y)] = tile_id
+
+    if len(tiles.mapped_chunks) == 0:
+        tiles.detach()
+
+    if (map_width, map_height) != (int(width), int(height)):
+        # The map was resized since, tiles may move in or out of bounds
+        resized = TileStore(width, height)
+        for x, y, tile_id in tiles:
+            resized.set(x, y, tile_id)
+        tiles.detach()
+        tiles = resized
+
+    world["map_tiles"] = tiles
+    return world
+
+def compress(value):
+    return zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+
+def decompress(blob):
+    return json.loads(zlib.decompress(blob))
@@ -0,0 +1,64 @@
+class SpatialHash:
+    # Buckets positions into square cells so range queries only look at
+    # the cells overlapping the query circle instead of every entry
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def cell_key(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def update(self, key, x, y):
+        cell = self.cell_key(x, y)
+        previous = self.positions.get(key)
+        if previous is not None:
+            previous_cell = self.cell_key(previous[0], previous[1])
+            if previous_cell != cell:
+                self.discard_from_cell(previous_cell, key)
+                self.cells.setdefault(cell, set()).add(key)
+        else:
+            self.cells.setdefault(cell, set()).add(key)
+
+        self.positions[key] = (x, y)
+
+    def remove(self, key):
+        position = self.positions.pop(key, None)
+        if position is not None:
+            self.discard_from_cell(self.cell_key(position[0], position[1]), key)
+
+    def discard_from_cell(self, cell, key):
+        keys = self.cells.get(cell)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                self.cells.pop(cell)
+
+    def get(self, key):
+        return self.positions.get(key)
+
+    def query(self, x, y, radius):
+        # Keys within radius of (x, y)
+        found = []
+        min_x, min_y = self.cell_key(x - radius, y - radius)
+        max_x, max_y = self.cell_key(x + radius, y + radius)
+        radius_squared = radius * radius
+
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                keys = self.cells.get((cell_x, cell_y))
+                if keys is None:
+                    continue
+
+                for key in keys:
+                    other_x, other_y = self.positions[key]
+                    if (other_x - x) ** 2 + (other_y - y) ** 2 <= radius_squared:
+                        found.append(key)
+        return found
@@ -0,0 +1,125 @@
+# Round trips of the binary world snapshot and the migration of map.json
+# and players.json to it. Run from the repository root: python -m pytest
+
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import server
+from droppeditems import DroppedItemStore
+from placeditems import PlacedItemStore
+from players import players_from_dict, players_to_dict
+from snapshot import read_snapshot, write_snapshot
+from tilestore import TileStore
+
+PLAYERS = {
+    "player1": {
+        "position": {"x": 100, "y": 200},
+        "inventory": {"3": 12},
+        "has_flashlight": True,
+        "holding_item": "pickaxe",
+        "current_drill_level": 2,
+        "money": 50
+    }
+}
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="minecat-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        tiles = TileStore(100, 100)
+        tiles.set(3, 4, 5)
+        tiles.set(99, 99, 0)
+        tiles.set(-1, 7, 2)
+        tiles.set(3000000000, -5000000000, 7)
+
+        dropped_items = DroppedItemStore(despawn_time=0)
+        dropped_items.add("stack1", "unit1", 10, 20, 4)
+        placed_items = PlacedItemStore.from_list([{"x": 5, "y": 6, "id": 1, "chest_id": "chest1"}])
+
+        path = os.path.join(self.directory, "world.bin")
+        world = {"map_tiles": tiles, "map_dropped_items": dropped_items, "map_placed_items": placed_items, "map_time": 12.5, "player_data": players_from_dict(PLAYERS)}
+        write_snapshot(path, world, 3, 4)
+
+        for lazy in (True, False):
+            data = read_snapshot(path, 100, 100, lazy=lazy)
+            self.assertEqual(sorted(data["map_tiles"]), sorted(tiles))
+            self.assertEqual(data["map_dropped_items"], json.loads(json.dumps(dropped_items.to_dict())))
+            self.assertEqual(data["map_placed_items"], placed_items.to_list())
+            self.assertEqual(data["map_time"], 12.5)
+            self.assertEqual(players_to_dict(data["player_data"]), PLAYERS)
+            self.assertEqual((data["map_seq"], data["player_seq"]), (3, 4))
+            data["map_tiles"].detach()
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="minecat-test-")
+        self.cwd = os.getcwd()
+        self.settings = copy.deepcopy(server.SERVER_SETTINGS)
+        os.chdir(self.directory)
+        os.mkdir("gamedata")
+        server.SNAPSHOT_SEQ.clear()
+
+        with open("server.json", "w") as outfile:
+            json.dump({
+                "map_seed": server.MAP_SEED,
+                "map_size": {"x": 100, "y": 100},
+                "map_generator_settings": server.MAP_GENERATOR_SETTINGS,
+                "map_poi": {},
+                "player_spawn_point": {"x": 1600, "y": 300},
+                "server_settings": {"snapshot_format": "binary", "persistence": "snapshot"}
+            }, outfile)
+
+    def tearDown(self):
+        server.MAP_TILES.detach()
+        server.SERVER_SETTINGS.clear()
+        server.SERVER_SETTINGS.update(self.settings)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_json(self, map_tiles):
+        with open(server.MAP_DATA_PATH, "w") as outfile:
+            json.dump({"map_tiles": map_tiles, "map_dropped_items": {}, "map_placed_items": [{"x": 5, "y": 6, "id": 1}], "map_time": 7, "journal_seq": 0}, outfile)
+        with open(server.PLAYER_DATA_PATH, "w") as outfile:
+            json.dump({"player_data": PLAYERS, "journal_seq": 0}, outfile)
+
+    def test_migration(self):
+        map_tiles = [{"x": 3, "y": 4, "id": 5}, {"x": 150, "y": 2, "id": 1}]
+        self.write_json(map_tiles)
+
+        server.load_fs_data()
+        self.assertTrue(os.path.exists(server.WORLD_SNAPSHOT_PATH))
+        self.assertTrue(os.path.exists(server.MAP_DATA_PATH + ".migrated"))
+        self.assertTrue(os.path.exists(server.PLAYER_DATA_PATH + ".migrated"))
+        server.MAP_TILES.detach()
+
+        # Started again, now from world.bin
+        server.load_fs_data()
+        self.assertEqual(sorted(server.MAP_TILES.to_list(), key=lambda tile: tile["x"]), map_tiles)
+        self.assertEqual(server.MAP_PLACED_ITEMS.to_list(), [{"x": 5, "y": 6, "id": 1}])
+        self.assertEqual(server.MAP_CURRENT_TIME, 7)
+        self.assertEqual(players_to_dict(server.PLAYER_DATA), PLAYERS)
+
+    def test_failed_load_is_not_migrated(self):
+        self.write_json([{"x": 3, "y": 4, "id": 4294967295}])
+
+        with self.assertRaises(Exception):
+            server.load_fs_data()
+        self.assertFalse(os.path.exists(server.WORLD_SNAPSHOT_PATH))
+        self.assertTrue(os.path.exists(server.MAP_DATA_PATH))
+        self.assertTrue(os.path.exists(server.PLAYER_DATA_PATH))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+from array import array
+import base64
+import struct
+import sys
+import zlib
+
+CHUNK_SIZE = 16
+
+# Chunk payload entry: cell index inside the chunk (row major), tile id
+CHUNK_ENTRY = struct.Struct("<Hi")
+
+# Marks a cell that still holds its generated tile
+EMPTY_TILE = -2147483648
+
+# Tile ids fit the int32 cells, EMPTY_TILE itself is not a tile id
+MIN_TILE_ID = EMPTY_TILE + 1
+MAX_TILE_ID = 2147483647
+
+class TileStore:
+    # Modified map tiles indexed by (x, y). Cells are kept in fixed size
+    # chunks of packed ints which are only allocated once a tile inside
+    # them is modified, so lookups are O(1) and there is no per-tile dict.
+
+    def __init__(self, width, height, chunk_size=CHUNK_SIZE):
+        self.width = int(width)
+        self.height = int(height)
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        self.chunk_counts = {}
+        self.outside = {}
+        self.count = 0
+        self.encoded_chunks = {}
+        # Chunks still in a memory mapped snapshot, key -> byte offset
+        self.mapped = None
+        self.mapped_chunks = {}
+
+    @classmethod
+    def from_list(cls, width, height, tiles):
+        store = cls(width, height)
+        for tile in tiles:
+            store.set(tile["x"], tile["y"], tile["id"])
+        return store
+
+    @classmethod
+    def from_mapped(cls, width, height, chunk_size, buffer, chunk_table):
+        # buffer holds little endian chunks of chunk_size * chunk_size int32
+        # cells, chunk_table lists (chunk x, chunk y, modified cells, offset).
+        # A chunk is only read from buffer once it is used.
+        store = cls(width, height, chunk_size)
+        store.mapped = buffer
+        for chunk_x, chunk_y, count, offset in chunk_table:
+            store.mapped_chunks[(chunk_x, chunk_y)] = offset
+            store.chunk_counts[(chunk_x, chunk_y)] = count
+            store.count += count
+        return store
+
+    def __len__(self):
+        return self.count + len(self.outside)
+
+    def __contains__(self, position):
+        return self.get(position[0], position[1]) is not None
+
+    def __iter__(self):
+        size = self.chunk_size
+        for chunk_x, chunk_y in list(self.chunk_counts.keys()):
+            cells = self.get_chunk((chunk_x, chunk_y))
+            base_x = chunk_x * size
+            base_y = chunk_y * size
+            for index, tile_id in enumerate(cells):
+                if tile_id != EMPTY_TILE:
+                    yield base_x + index % size, base_y + index // size, tile_id
+
+        for (x, y), tile_id in self.outside.items():
+            yield x, y, tile_id
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def chunk_key(self, x, y):
+        return x // self.chunk_size, y // self.chunk_size
+
+    def get_chunk(self, key):
+        cells = self.chunks.get(key)
+        if cells is None and len(self.mapped_chunks) > 0:
+            cells = self.load_chunk(key)
+        return cells
+
+    def load_chunk(self, key):
+        offset = self.mapped_chunks.pop(key, None)
+        if offset is None:
+            return None
+
+        cells = array("i")
+        cells.frombytes(self.mapped[offset:offset + 4 * self.chunk_size * self.chunk_size])
+        if sys.byteorder == "big":
+            cells.byteswap()
+        self.chunks[key] = cells
+
+        if len(self.mapped_chunks) == 0:
+            self.detach()
+        return cells
+
+    def chunk_bytes(self, key):
+        # Little endian cells of a chunk, straight from the mapped snapshot
+        # when it hasn't been loaded
+        offset = self.mapped_chunks.get(key)
+        if offset is not None:
+            return self.mapped[offset:offset + 4 * self.chunk_size * self.chunk_size]
+
+        cells = self.chunks[key]
+        if sys.byteorder == "big":
+            cells = array("i", cells)
+            cells.byteswap()
+        return cells.tobytes()
+
+    def detach(self):
+        # Loads the chunks still in the snapshot, after which the snapshot
+        # file may be replaced
+        for key in list(self.mapped_chunks.keys()):
+            self.load_chunk(key)
+
+        if self.mapped is not None:
+            if hasattr(self.mapped, "close"):
+                self.mapped.close()
+            self.mapped = None
+
+    def get(self, x, y, default=None):
+        x = int(x)
+        y = int(y)
+
+        if not self.in_bounds(x, y):
+            return self.outside.get((x, y), default)
+
+        cells = self.get_chunk((x // self.chunk_size, y // self.chunk_size))
+        if cells is None:
+            return default
+
+        tile_id = cells[(y % self.chunk_size) * self.chunk_size + x % self.chunk_size]
+        return default if tile_id == EMPTY_TILE else tile_id
+
+    def set(self, x, y, tile_id):
+        # Returns True when the stored tile changed
+        x = int(x)
+        y = int(y)
+        tile_id = int(tile_id)
+        if tile_id < MIN_TILE_ID or tile_id > MAX_TILE_ID:
+            raise ValueError("Tile id out of range: " + str(tile_id))
+
+        if not self.in_bounds(x, y):
+            if self.outside.get((x, y)) == tile_id:
+                return False
+            self.outside[(x, y)] = tile_id
+            return True
+
+        key = (x // self.chunk_size, y // self.chunk_size)
+        cells = self.get_chunk(key)
+        if cells is None:
+            cells = array("i", [EMPTY_TILE]) * (self.chunk_size * self.chunk_size)
+            self.chunks[key] = cells
+            self.chunk_counts[key] = 0
+
+        index = (y % self.chunk_size) * self.chunk_size + x % self.chunk_size
+        previous = cells[index]
+        if previous == tile_id:
+            return False
+
+        if previous == EMPTY_TILE:
+            self.chunk_counts[key] += 1
+            self.count += 1
+
+        cells[index] = tile_id
+        self.encoded_chunks.pop(key, None)
+        return True
+
+    def remove(self, x, y):
+        # Resets a cell to its generated tile, returns True if it was modified
+        x = int(x)
+        y = int(y)
+
+        if not self.in_bounds(x, y):
+            return self.outside.pop((x, y), None) is not None
+
+        key = (x // self.chunk_size, y // self.chunk_size)
+        cells = self.get_chunk(key)
+        if cells is None:
+            return False
+
+        index = (y % self.chunk_size) * self.chunk_size + x % self.chunk_size
+        if cells[index] == EMPTY_TILE:
+            return False
+
+        cells[index] = EMPTY_TILE
+        self.encoded_chunks.pop(key, None)
+        self.count -= 1
+        self.chunk_counts[key] -= 1
+        if self.chunk_counts[key] == 0:
+            self.chunks.pop(key)
+            self.chunk_counts.pop(key)
+        return True
+
+    def to_list(self):
+        return [{"x": x, "y": y, "id": tile_id} for x, y, tile_id in self]
+
+    def chunks_by_distance(self, x, y, radius=None):
+        # Keys of all modified chunks, nearest to tile (x, y) first
+        center_x, center_y = self.chunk_key(int(x), int(y))
+
+        def distance(key):
+            return max(abs(key[0] - center_x), abs(key[1] - center_y))
+
+        keys = sorted(self.chunk_counts.keys(), key=distance)
+        if radius is not None:
+            keys = [key for key in keys if distance(key) <= radius]
+        return keys
+
+    def encode_chunk(self, key):
+        # Zlib compressed, base64 encoded list of CHUNK_ENTRY records for
+        # the modified cells of a chunk. Cached until the chunk changes.
+        encoded = self.encoded_chunks.get(key)
+        if encoded is None:
+            cells = self.get_chunk(key) or ()
+            packed = bytearray()
+            for index, tile_id in enumerate(cells):
+                if tile_id != EMPTY_TILE:
+                    packed += CHUNK_ENTRY.pack(index, tile_id)
+
+            encoded = {
+                "x": key[0],
+                "y": key[1],
+                "size": self.chunk_size,
+                "tiles": base64.b64encode(zlib.compress(bytes(packed))).decode("ascii")
+            }
+            self.encoded_chunks[key] = encoded
+        return encoded
@@ -0,0 +1,163 @@
+import os
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+
+import logging
+import asyncio
+import itertools
+import struct
+from collections import deque
+
+from ipc import LINK_HIGH_WATER, read_frame, write_frame
+from protocol import decode_message
+
+# Front-end worker for multiworker.py. Handles the websocket connections
+# and message decoding, everything else happens in the state owner
+# (server.py) it is linked to over a Unix socket.
+
+IPC_SOCKET_PATH = os.environ.get("MINECAT_IPC_SOCKET", "./gamedata/ipc.sock")
+
+# Outbound messages buffered per client before it is disconnected
+WORKER_SEND_QUEUE_SIZE = 1024
+
+app = FastAPI()
+logger = logging.getLogger("uvicorn.info")
+
+class OwnerLink:
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.connections = {}
+        self.connection_ids = itertools.count(1)
+
+    async def connect(self):
+        # The owner may still be loading the world
+        for _ in range(300):
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(IPC_SOCKET_PATH)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError("State owner is not listening on " + IPC_SOCKET_PATH)
+
+        asyncio.get_running_loop().create_task(self.run())
+        logger.info("Worker " + str(os.getpid()) + " linked to " + IPC_SOCKET_PATH)
+
+    def send(self, message):
+        write_frame(self.writer, message)
+
+    async def drain(self):
+        if self.writer.transport.get_write_buffer_size() > LINK_HIGH_WATER:
+            await self.writer.drain()
+
+    async def run(self):
+        try:
+            while True:
+                message = await read_frame(self.reader)
+
+                if message[0] == "send":
+                    _, connection_ids, payload, mode = message
+                    for connection_id in connection_ids:
+                        connection = self.connections.get(connection_id)
+                        if connection is not None:
+                            connection.put(payload, mode)
+
+                elif message[0] == "close":
+                    connection = self.connections.get(message[1])
+                    if connection is not None:
+                        connection.close(message[2])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.error("Lost the link to the state owner, closing all connections")
+            for connection in list(self.connections.values()):
+                connection.close(1012)
+
+class Connection:
+    # Writer for one client, so a slow socket doesn't hold up the link
+
+    def __init__(self, websocket: WebSocket, connection_id):
+        self.websocket = websocket
+        self.connection_id = connection_id
+        self.messages = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def put(self, payload, mode):
+        if self.closed:
+            return
+
+        if len(self.messages) >= WORKER_SEND_QUEUE_SIZE:
+            logger.warning("Disconnecting connection " + str(self.connection_id) + ", send queue is full")
+            self.close(1008)
+            return
+
+        self.messages.append((payload, mode))
+        self.ready.set()
+
+    async def run(self):
+        while not self.closed:
+            if len(self.messages) == 0:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            payload, mode = self.messages.popleft()
+            try:
+                if mode == "text":
+                    await self.websocket.send_text(payload)
+                else:
+                    await self.websocket.send_bytes(payload)
+            except Exception as exception:
+                logger.info("Stopped sending to connection " + str(self.connection_id) + ": " + repr(exception))
+                self.closed = True
+
+    def close(self, code=1000, close_websocket=True):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.messages.clear()
+        self.ready.set()
+        if close_websocket:
+            asyncio.get_running_loop().create_task(self.websocket.close(code=code))
+
+owner = OwnerLink()
+
+@app.on_event("startup")
+async def startup_event():
+    await owner.connect()
+
+@app.websocket("/")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+
+    connection_id = next(owner.connection_ids)
+    connection = Connection(websocket, connection_id)
+    owner.connections[connection_id] = connection
+    owner.send(("open", connection_id))
+
+    code = 1000
+    client_closed = False
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                code = frame.get("code", 1000)
+                client_closed = True
+                break
+
+            try:
+                data = decode_message(frame)
+            except (ValueError, struct.error):
+                code = 1003
+                break
+
+            owner.send(("message", connection_id, data, frame))
+            await owner.drain()
+    except WebSocketDisconnect as exception:
+        code = exception.code
+        client_closed = True
+    finally:
+        owner.connections.pop(connection_id, None)
+        connection.close(code, close_websocket=not client_closed)
+        owner.send(("close", connection_id, code))